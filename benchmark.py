@@ -0,0 +1,329 @@
+"""Replay a synthetic workload against each storage backend
+
+Usage:
+    python benchmark.py
+    python benchmark.py --backends sqlite --users 1000,100000 --ops 5000
+    python benchmark.py --memory --users 100000 --transactions 1000000
+    python benchmark.py --stress --users 100 --concurrency 1,16,64
+    python benchmark.py --head-of-line --concurrency 4
+    python benchmark.py --double-tap
+
+Reports throughput (ops/sec) and p99 latency per operation type, or with
+--memory the heap used by dict records versus the slotted record types, or
+with --stress buy taps run through the bot's update processor and purchase
+handler against a fake Telegram, with any double-spends, or
+with --head-of-line how long one user's backlog delays another user, or with
+--double-tap whether a second tap on a slow buy is ignored.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from records import Transaction, User
+from storage import open_storage
+
+ADMIN_ID = 1
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of samples (seconds)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def deposit(storage, user_id, n):
+    """A user pays through the QR flow and an admin verifies it"""
+    payment_id = f"PAY_{user_id}_{n}"
+    storage.create_payment(payment_id, user_id)
+    storage.update_payment_utr(payment_id, f"{n:012d}")
+    storage.verify_payment(payment_id, 100.0, ADMIN_ID)
+
+def check_balance(storage, user_id):
+    """What the "Check Balance" screen reads"""
+    storage.get_user(user_id)
+    storage.get_user_transactions(user_id, limit=5)
+
+def run(backend, users, ops, seed=0):
+    """Populate a fresh backend with users, then replay a mixed workload"""
+    data_dir = tempfile.mkdtemp(prefix=f"bench_{backend}_")
+    storage = open_storage(backend, data_dir, default_admin=ADMIN_ID)
+    timings = {'register': [], 'deposit': [], 'purchase': [], 'balance': [], 'stats': []}
+
+    def timed(kind, fn, *args):
+        start = time.perf_counter()
+        fn(*args)
+        timings[kind].append(time.perf_counter() - start)
+
+    try:
+        for user_id in range(1, users + 1):
+            timed('register', storage.create_user, user_id, f"user{user_id}", "Bench", None)
+
+        # Enough stock that no purchase runs out; users who never deposited are refused
+        for i in range(ops):
+            storage.add_twitter_account(f"bench{i}", "password", f"bench{i}@example.com", ADMIN_ID)
+
+        rng = random.Random(seed)
+        for n in range(ops):
+            user_id = rng.randint(1, users)
+            roll = rng.random()
+            if roll < 0.4:
+                timed('deposit', deposit, storage, user_id, n)
+            elif roll < 0.7:
+                timed('purchase', storage.purchase_twitter_account, user_id, 1)
+            elif roll < 0.99:
+                timed('balance', check_balance, storage, user_id)
+            else:
+                timed('stats', storage.get_statistics)
+    finally:
+        storage.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return timings
+
+def load_bot():
+    """Import bot.py with just enough configuration to drive its handlers offline"""
+    # bot.py reads the admin and database chat ids from these variables
+    os.environ.setdefault("1728951776", str(ADMIN_ID))
+    os.environ.setdefault("7445817691", "-1")
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_bot_"))
+    import bot
+    return bot
+
+class FakeBot:
+    """Answers every Bot API call after latency seconds, like a slow network"""
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def call(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+
+    answer_callback_query = edit_message_text = send_message = send_document = delete_message = call
+
+def buy_tap(bot, fake, update_id, user_id, quantity, message_id=None):
+    """The update Telegram sends when a user taps one of the "Twitter N" buttons"""
+    return bot.Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': "Bench"},
+            'chat_instance': str(user_id),
+            'data': bot.encode_callback(bot.CB_BUY, quantity),
+            'message': {'message_id': message_id or update_id, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}}
+        }
+    }, fake)
+
+def open_shop(bot, backend, data_dir, fake, users, affordable, stock):
+    """Point the bot's handlers at a fresh backend whose users can each afford some accounts"""
+    storage = open_storage(backend, data_dir, default_admin=ADMIN_ID)
+    funded = affordable * storage.get_twitter_price()
+    for user_id in range(1, users + 1):
+        storage.create_user(user_id, f"user{user_id}", "Bench", None)
+        storage.update_balance(user_id, funded)
+    for i in range(stock):
+        storage.add_twitter_account(f"stress{i}", "password", f"stress{i}@example.com", ADMIN_ID)
+    bot.db = bot.ChatDatabase(fake, storage)
+    bot.callback_cache = bot.IdempotencyCache()
+    bot.audit_log = bot.AuditLog()
+    return storage
+
+def head_of_line(backend, backlog, concurrency, latency):
+    """Seconds another user's tap takes while one user has backlog taps queued, and alone"""
+    bot = load_bot()
+    data_dir = tempfile.mkdtemp(prefix=f"hol_{backend}_")
+    fake = FakeBot(latency)
+    storage = open_shop(bot, backend, data_dir, fake, 2, backlog + 2, backlog + 2)
+    try:
+        async def timed_tap(processor, update):
+            start = time.perf_counter()
+            await processor.process_update(update, bot.handle_callback(update, SimpleNamespace(bot=fake, user_data={})))
+            return time.perf_counter() - start
+
+        async def replay():
+            processor = bot.PerUserUpdateProcessor(concurrency)
+            alone = await timed_tap(processor, buy_tap(bot, fake, 1, 2, 1))
+            busy = [asyncio.create_task(timed_tap(processor, buy_tap(bot, fake, n, 1, 1))) for n in range(2, backlog + 2)]
+            await asyncio.sleep(0)
+            bystander = await timed_tap(processor, buy_tap(bot, fake, backlog + 2, 2, 1))
+            await asyncio.gather(*busy)
+            return bystander, alone
+
+        return asyncio.run(replay())
+    finally:
+        storage.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def double_tap(backend, latency):
+    """Accounts bought by two taps on one buy button while delivery outlasts the double-tap window"""
+    bot = load_bot()
+    data_dir = tempfile.mkdtemp(prefix=f"tap_{backend}_")
+    fake = FakeBot(latency)
+    storage = open_shop(bot, backend, data_dir, fake, 1, 10, 10)
+    window = bot.CALLBACK_DOUBLE_TAP_WINDOW
+    bot.CALLBACK_DOUBLE_TAP_WINDOW = latency / 4
+    try:
+        first, second = buy_tap(bot, fake, 1, 1, 1), buy_tap(bot, fake, 2, 1, 1, message_id=1)
+
+        async def replay():
+            processor = bot.PerUserUpdateProcessor(4)
+            await asyncio.gather(*(
+                processor.process_update(update, bot.handle_callback(update, SimpleNamespace(bot=fake, user_data={})))
+                for update in (first, second)
+            ))
+
+        asyncio.run(replay())
+        return storage.get_user(1)['total_purchases']
+    finally:
+        bot.CALLBACK_DOUBLE_TAP_WINDOW = window
+        storage.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def stress(backend, users, taps, concurrency, latency, seed=0):
+    """Concurrent buy taps through the bot's update processor and purchase handler"""
+    bot = load_bot()
+    data_dir = tempfile.mkdtemp(prefix=f"stress_{backend}_")
+    fake = FakeBot(latency)
+    # Every user can afford three accounts, and there is less stock than they could buy,
+    # so both limits get hit
+    storage = open_shop(bot, backend, data_dir, fake, users, 3, 2 * users)
+    try:
+        funded = 3 * storage.get_twitter_price()
+        rng = random.Random(seed)
+        plan = [buy_tap(bot, fake, n, rng.randint(1, users), rng.randint(1, 2)) for n in range(1, taps + 1)]
+
+        async def replay():
+            processor = bot.PerUserUpdateProcessor(concurrency)
+            await asyncio.gather(*(
+                processor.process_update(update, bot.handle_callback(update, SimpleNamespace(bot=fake, user_data={})))
+                for update in plan
+            ))
+
+        start = time.perf_counter()
+        asyncio.run(replay())
+        elapsed = time.perf_counter() - start
+
+        data = storage.export_data()
+        sold = {}
+        for account in data['twitter_stock']:
+            if account['is_sold']:
+                sold[account['sold_to']] = sold.get(account['sold_to'], 0) + 1
+        violations = 0
+        for user in data['users'].values():
+            if (user['balance'] < 0 or sold.get(user['user_id'], 0) != user['total_purchases']
+                    or abs(user['balance'] + user['total_spent'] - funded) > 0.005):
+                violations += 1
+        return elapsed, sum(sold.values()), violations
+    finally:
+        storage.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def sample_records(users, transactions):
+    """Users and transactions in the JSON layout, as the bot used to hold them"""
+    start = datetime(2024, 1, 1)
+    for user_id in range(1, users + 1):
+        yield 'users', {
+            'user_id': user_id, 'username': f"user{user_id}", 'first_name': "Bench", 'last_name': None,
+            'balance': 125.0, 'total_spent': 50.0, 'total_purchases': 2,
+            'join_date': str(start + timedelta(seconds=user_id)), 'last_active': str(start + timedelta(seconds=user_id))
+        }
+    for n in range(transactions):
+        created = str(start + timedelta(seconds=n, microseconds=n % 1000000))
+        yield 'transactions', {
+            'transaction_id': f"TWITTER_{n % users + 1}_{1700000000 + n}", 'user_id': n % users + 1,
+            'amount': 15.0, 'type': 'purchase_twitter', 'status': 'completed',
+            'details': "Purchased 3 Twitter accounts @ ₹5 each", 'created_at': created, 'completed_at': created
+        }
+
+def measure(build, users, transactions):
+    """Heap bytes held by whatever build() returns"""
+    gc.collect()
+    tracemalloc.start()
+    held = build(sample_records(users, transactions))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return size
+
+def memory_report(users, transactions):
+    """Compare dict records with the slotted record types"""
+    types = {'users': User, 'transactions': Transaction}
+    layouts = {
+        'dict': lambda records: [record for _, record in records],
+        'slotted': lambda records: [types[kind].from_dict(record) for kind, record in records]
+    }
+    print(f"{'layout':<8} {'users':>9} {'transactions':>13} {'MB':>10}")
+    for layout, build in layouts.items():
+        size = measure(build, users, transactions)
+        print(f"{layout:<8} {users:>9} {transactions:>13} {size / 2**20:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default="memory,json,sqlite")
+    parser.add_argument("--users", default="1000,100000,1000000", help="comma separated user counts")
+    parser.add_argument("--ops", type=int, default=20000, help="mixed operations after registration")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory", action="store_true", help="measure record memory instead of throughput")
+    parser.add_argument("--transactions", type=int, default=1000000, help="transactions for --memory")
+    parser.add_argument("--stress", action="store_true", help="concurrent purchase taps instead of the mixed workload")
+    parser.add_argument("--taps", type=int, default=2000, help="purchase taps for --stress")
+    parser.add_argument("--concurrency", default="1,16,64", help="comma separated handlers in flight for --stress")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds per simulated Telegram call for --stress")
+    parser.add_argument("--head-of-line", action="store_true", help="check one user's backlog does not delay others")
+    parser.add_argument("--backlog", type=int, default=8, help="taps queued by one user for --head-of-line")
+    parser.add_argument("--double-tap", action="store_true", help="check a second tap on a slow buy is ignored")
+    args = parser.parse_args()
+
+    if args.double_tap:
+        failed = False
+        print(f"{'backend':<8} {'purchases':>10}")
+        for backend in args.backends.split(","):
+            purchases = double_tap(backend, max(args.latency, 0.2))
+            print(f"{backend:<8} {purchases:>10}")
+            failed |= purchases != 1
+        sys.exit(1 if failed else 0)
+
+    if args.head_of_line:
+        failed = False
+        print(f"{'backend':<8} {'handlers':>9} {'backlog':>8} {'alone ms':>9} {'bystander ms':>13}")
+        for backend in args.backends.split(","):
+            for concurrency in (int(n) for n in args.concurrency.split(",")):
+                bystander, alone = head_of_line(backend, args.backlog, concurrency, args.latency)
+                print(f"{backend:<8} {concurrency:>9} {args.backlog:>8} {alone * 1000:>9.0f} {bystander * 1000:>13.0f}")
+                # The bystander may wait for one running tap, never for the queued ones
+                failed |= bystander > 2.5 * alone
+        sys.exit(1 if failed else 0)
+
+    if args.memory:
+        for users in (int(n) for n in args.users.split(",")):
+            memory_report(users, args.transactions)
+        return
+
+    if args.stress:
+        failed = False
+        print(f"{'backend':<8} {'users':>9} {'handlers':>9} {'taps/sec':>10} {'sold':>8} {'double-spends':>14}")
+        for backend in args.backends.split(","):
+            for users in (int(n) for n in args.users.split(",")):
+                for concurrency in (int(n) for n in args.concurrency.split(",")):
+                    elapsed, sold, violations = stress(backend, users, args.taps, concurrency, args.latency, args.seed)
+                    print(f"{backend:<8} {users:>9} {concurrency:>9} {args.taps / elapsed:>10.0f} {sold:>8} {violations:>14}")
+                    failed |= violations > 0
+        sys.exit(1 if failed else 0)
+
+    print(f"{'backend':<8} {'users':>9} {'operation':<10} {'count':>8} {'ops/sec':>12} {'p99 ms':>10}")
+    for backend in args.backends.split(","):
+        for users in (int(n) for n in args.users.split(",")):
+            timings = run(backend, users, args.ops, args.seed)
+            for kind, samples in timings.items():
+                total = sum(samples)
+                rate = len(samples) / total if total else 0.0
+                print(f"{backend:<8} {users:>9} {kind:<10} {len(samples):>8} {rate:>12.0f} {percentile(samples, 99) * 1000:>10.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,24 @@ import asyncio
 import pickle
 import base64
 from typing import Dict, List, Tuple, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
+import time
 import io
+import csv
 import hashlib
+import secrets
+import signal
+import gzip
+import weakref
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import count, takewhile
+
+try:
+    import zstandard
+except ImportError:  # gzip is always available as a fallback
+    zstandard = None
 
 from telegram import (
     Update, 
@@ -20,6 +34,8 @@ from telegram import (
 )
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -29,19 +45,15 @@ from telegram.ext import (
 )
 from aiohttp import web
 
+from storage import STORAGE_API, Storage, open_storage, write_file_atomic
+
 async def home(request):
     return web.Response(text="Bot is running 🚀")
 
 app = web.Application()
 app.router.add_get("/", home)
-
-if __name__ == "__main__":
-    web.run_app(
-        app,
-        host="0.0.0.0",
-        port=10000  # Render default
-    )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 
 # ==================== CONFIGURATION ====================
 BOT_TOKEN = os.getenv("8379260877:AAHFpHyQ160STBAl_wA0iNN7-S6x5ZMB2hY")
@@ -49,346 +61,986 @@ ADMIN_PASSWORD = os.getenv("killer123")
 ADMIN_CHAT_ID = int(os.getenv("1728951776"))
 DATABASE_CHAT_ID = int(os.getenv("7445817691"))
 
+# Updates arrive by webhook when the service has a public URL, otherwise by long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", os.getenv("RENDER_EXTERNAL_URL", ""))
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)  # Telegram echoes it in a header
+PORT = int(os.getenv("PORT", "10000"))  # Render default
+
 # Twitter Account Price
 TWITTER_PRICE = 5 # 5₹ per account
 
+# Local persistence
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "memory", "json" or "sqlite"
+DATA_DIR = os.getenv("DATA_DIR", "data")
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, "bot.sqlite3"))
+WAL_FSYNC = os.getenv("WAL_FSYNC", "0") == "1"
+WAL_COMPACT_EVERY = int(os.getenv("WAL_COMPACT_EVERY", "200"))  # log records per snapshot
+SNAPSHOT_GENERATIONS = int(os.getenv("SNAPSHOT_GENERATIONS", "3"))  # local snapshots kept for rollback
+STATS_CHECK = os.getenv("STATS_CHECK", "0") == "1"  # debug: verify /statics totals against a full recompute
+
+# Cold archive: old records leave memory for compressed segment files
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))  # any transaction or payment older than this
+PAYMENT_RETENTION_DAYS = float(os.getenv("PAYMENT_RETENTION_DAYS", "7"))  # verified payments kept hot this long
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))  # seconds between archive passes
+
+# Reports
+REPORT_MAX_BUCKETS = 31  # per-hour/per-day lines shown by /report
+
+# Update handling: concurrent across users, one at a time per user
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # updates handled at once
+
+# Checkout
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", "600"))  # seconds a checkout may hold stock and funds
+HOUSEKEEPING_INTERVAL = 30  # seconds between sweeps of expired reservations and callback cache saves
+DELIVERY_DOCUMENT_MIN = int(os.getenv("DELIVERY_DOCUMENT_MIN", "10"))  # orders this large arrive as one CSV file
+
+# Duplicate button taps
+CALLBACK_DEDUP_TTL = float(os.getenv("CALLBACK_DEDUP_TTL", "600"))  # seconds a handled button tap is remembered
+CALLBACK_DEDUP_SIZE = 10000  # most remembered taps
+CALLBACK_DOUBLE_TAP_WINDOW = 5  # seconds a second Check Payment tap on the same message is ignored
+CALLBACK_CACHE_PATH = os.path.join(DATA_DIR, "callbacks.json")
+
+# Broadcasts
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))  # sends in flight at once
+BROADCAST_RETRIES = 3  # attempts per user on network errors
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between progress edits and checkpoints
+BROADCAST_CHECKPOINT_PATH = os.path.join(DATA_DIR, "broadcast.json")
+
+# Outgoing messages
+MESSAGE_MAX_CHARS = 4000  # packed messages, with a margin under the 4096-character limit
+
+# Audit log
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "2"))  # seconds audit events wait to share a message
+AUDIT_DOCUMENT_MIN_CHARS = 3 * MESSAGE_MAX_CHARS  # a backlog larger than this goes out as one text file
+AUDIT_MAX_PENDING = 10000  # oldest audit events are dropped beyond this while the chat is unreachable
+
+# Outbound rate limits
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "25"))  # messages/sec across all chats, under Telegram's ~30/sec
+OUTBOUND_RETRIES = 3  # times a call is retried after RetryAfter before the caller sees it
+PRIVATE_CHAT_RATE = 1.0  # messages/sec per private chat, in bursts of CHAT_BURST
+GROUP_CHAT_RATE = 20 / 60  # messages/sec per group, Telegram allows about 20 a minute
+CHAT_BURST = 3
+
+# Chat backups
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "60"))  # at most one chat backup per interval (seconds)
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC", "zstd" if zstandard else "gzip")
+# Bots can only download files up to 20 MB, so larger snapshots are split
+SNAPSHOT_CHUNK_SIZE = int(os.getenv("SNAPSHOT_CHUNK_SIZE", str(19 * 1024 * 1024)))
+SNAPSHOT_CACHE_DIR = os.path.join(DATA_DIR, "chat_cache")
+DELTAS_PER_BASE = int(os.getenv("DELTAS_PER_BASE", "10"))  # full snapshot after this many deltas
+MANIFEST_MAX_CHARS = 3000  # leave room under Telegram's 4096-character message limit
+
 # Conversation states
 WAITING_FOR_QR, WAITING_FOR_PAYMENT_VERIFICATION, WAITING_FOR_TWITTER_DETAILS = range(3)
 
+# ==================== SNAPSHOT FORMAT ====================
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def encode_snapshot(data: dict, codec: str = SNAPSHOT_CODEC) -> io.BytesIO:
+    """Stream data as JSON through a compressor into a single buffer"""
+    buf = io.BytesIO()
+    if codec == "zstd" and zstandard:
+        stream = zstandard.ZstdCompressor().stream_writer(buf, closefd=False)
+    else:
+        stream = gzip.GzipFile(fileobj=buf, mode="wb", mtime=0)
+    with io.TextIOWrapper(stream, encoding="utf-8") as text:
+        json.dump(data, text, default=str, separators=(",", ":"))
+    buf.seek(0)
+    return buf
+
+def decode_snapshot(blob) -> dict:
+    """Decompress and parse a snapshot produced by encode_snapshot"""
+    if bytes(blob[:4]) == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this snapshot")
+        stream = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(blob))
+    else:
+        stream = gzip.GzipFile(fileobj=io.BytesIO(blob), mode="rb")
+    with io.TextIOWrapper(stream, encoding="utf-8") as text:
+        return json.load(text)
+
+def manifest_age(manifest: dict) -> Tuple[int, int]:
+    """Sort key for manifests: ids are "<unix time>_<storage seq>" """
+    timestamp, _, seq = str(manifest.get('id', '0')).partition('_')
+    return int(timestamp), int(seq or 0)
+
 # ==================== CHAT DATABASE SYSTEM ====================
 class ChatDatabase:
-    def __init__(self, bot=None):
+    """Storage backend plus snapshot backups to the database chat"""
+    def __init__(self, bot=None, storage: Storage = None):
         self.bot = bot
-        self.data = {
-            'users': {},
-            'twitter_stock': [],
-            'transactions': [],
-            'payments': [],
-            'admin_settings': {},
-            'used_twitter_accounts': set(),
-            'admins': [ADMIN_CHAT_ID]  # Default admin list
-        }
-        self.load_from_chat()
-    
-    async def save_to_chat(self, context):
-        """Save database to chat as encoded message"""
+        self.storage = storage if storage is not None else open_storage(
+            STORAGE_BACKEND, DATA_DIR, SQLITE_PATH,
+            default_admin=ADMIN_CHAT_ID, default_price=TWITTER_PRICE,
+            fsync=WAL_FSYNC, generations=SNAPSHOT_GENERATIONS, check_statistics=STATS_CHECK
+        )
+        self.backup_seq = self.storage.seq  # storage.seq at the last chat backup
+        self.pinned_message_id = None
+        self.chain = None  # manifest of the last uploaded base + deltas
+        self.archived_at = 0.0
+        self.segment_blobs = self.read_cached_segments()  # cold segment name -> uploaded blob
+    
+    def __getattr__(self, name):
+        # Data access goes through the Storage protocol only
+        if name in STORAGE_API:
+            return getattr(self.storage, name)
+        raise AttributeError(f"{type(self).__name__} has no attribute {name!r}")
+    
+    def reserve(self, user_id: int, quantity: int):
+        """Check balance and stock and hold both in one step; returns (reservation, None) or (None, reason)"""
+        # Nothing awaits between the checks and the reservation, so concurrent
+        # handlers cannot both spend the same balance or the same stock
+        user = self.storage.get_user(user_id)
+        if user is None or user['balance'] < quantity * self.storage.get_twitter_price():
+            return None, 'balance'
+        if self.storage.get_available_twitter_count() < quantity:
+            return None, 'stock'
+        reservation = self.storage.reserve_twitter_accounts(user_id, quantity, RESERVATION_TTL)
+        return (reservation, None) if reservation else (None, 'failed')
+    
+    async def checkpoint(self, context=None, force: bool = False):
+        """Compact local storage and back it up to chat if anything changed"""
+        if not force and self.storage.seq == self.backup_seq:
+            return True
         try:
-            # Convert data to JSON and then encode
-            data_str = json.dumps(self.data, default=str)
-            encoded_data = base64.b64encode(data_str.encode()).decode()
+            # Records are picked and dropped here; serializing and writing files happens off the event loop
+            if time.monotonic() - self.archived_at >= ARCHIVE_INTERVAL:
+                self.archived_at = time.monotonic()
+                now = datetime.now()
+                plan = self.storage.plan_archive(
+                    now - timedelta(days=ARCHIVE_AFTER_DAYS),
+                    now - timedelta(days=PAYMENT_RETENTION_DAYS)
+                )
+                if plan:
+                    await asyncio.to_thread(self.storage.write_archive, plan)
+                    if self.storage.finish_archive(plan):
+                        self.chain = None  # deltas cannot express archived records, so start a new base
+            job = self.storage.compaction_job(0 if force else WAL_COMPACT_EVERY)
+            if job:
+                await asyncio.to_thread(job)
+        except Exception as e:
+            logging.error(f"Error compacting database: {e}")
+            return False
+        seq = self.storage.seq
+        success = await self.save_to_chat(context)
+        if success:
+            self.backup_seq = seq
+        return success
+    
+    # ---------- chat backup ----------
+    async def upload_blob(self, bot, buf: io.BytesIO, label: str):
+        """Upload one encoded snapshot as numbered document parts and describe it"""
+        size = buf.getbuffer().nbytes
+        digest = hashlib.sha256(buf.getbuffer()).hexdigest()
+        total_parts = max(1, -(-size // SNAPSHOT_CHUNK_SIZE))
+        
+        part_ids = []
+        for part in range(total_parts):
+            if total_parts == 1:
+                document = buf
+            else:
+                document = io.BytesIO(buf.read(SNAPSHOT_CHUNK_SIZE))
+            message = await bot.send_document(
+                chat_id=DATABASE_CHAT_ID,
+                document=InputFile(document, filename=f"{label}.part{part + 1:03d}"),
+                caption=f"📊 DATABASE BACKUP {label} part {part + 1}/{total_parts}",
+                rate_limit_args=LANE_AUDIT
+            )
+            part_ids.append(message.document.file_id)
+        
+        self.write_cached_blob(digest, buf.getbuffer())
+        return {'size': size, 'sha256': digest, 'parts': part_ids}
+    
+    async def upload_segments(self, bot, data: dict):
+        """Upload cold segments the chat does not have yet and list them in the base"""
+        if 'archive' not in data:
+            return
+        segments = data['archive']['segments']
+        for name in segments:
+            if name not in self.segment_blobs:
+                buf = io.BytesIO(self.storage.read_segment(name))
+                self.segment_blobs[name] = await self.upload_blob(bot, buf, name)
+                self.write_cached_segments()
+        # Segments are immutable, so each is uploaded once and only referenced afterwards
+        data['archive']['blobs'] = {name: self.segment_blobs[name] for name in segments}
+    
+    async def save_to_chat(self, context=None, full: bool = False):
+        """Upload a full base snapshot or a delta of changed records, then pin the manifest"""
+        try:
+            bot = context.bot if context else self.bot
+            snapshot_id = f"{int(datetime.now().timestamp())}_{self.storage.seq}"
             
-            # Save to chat
-            await context.bot.send_message(
+            # A new base bounds restore time and keeps the manifest under the message limit
+            full = (
+                full
+                or self.chain is None
+                or len(self.chain['deltas']) >= DELTAS_PER_BASE
+                or len(json.dumps(self.chain)) > MANIFEST_MAX_CHARS
+            )
+            if full:
+                self.storage.clear_dirty()
+                data = await asyncio.to_thread(self.storage.export_job())
+                await self.upload_segments(bot, data)
+                buf = await asyncio.to_thread(encode_snapshot, data)
+            else:
+                buf = encode_snapshot(self.storage.export_delta())
+            
+            try:
+                blob = await self.upload_blob(bot, buf, f"{'base' if full else 'delta'}_{snapshot_id}")
+            except Exception:
+                # Dirty records were already handed over; start a fresh chain next time
+                self.chain = None
+                raise
+            
+            # The manifest is what load_from_chat reassembles from: base plus deltas in order
+            if full:
+                manifest = {'v': 3, 'id': snapshot_id, 'codec': SNAPSHOT_CODEC, 'base': blob, 'deltas': []}
+            else:
+                manifest = dict(self.chain, id=snapshot_id, deltas=self.chain['deltas'] + [blob])
+            self.chain = manifest
+            
+            message = await bot.send_message(
                 chat_id=DATABASE_CHAT_ID,
-                text=f"📊 DATABASE BACKUP\nTime: {datetime.now()}\n\n{encoded_data}"
+                text=f"📊 DATABASE BACKUP\nTime: {datetime.now()}\n{json.dumps(manifest)}",
+                rate_limit_args=LANE_AUDIT
             )
+            self.write_cached_manifest(manifest)
+            
+            # Pin the manifest so a restart finds it with one get_chat call; an unpinned
+            # manifest would leave an older one pinned, so the backup counts as failed and retries
+            await bot.pin_chat_message(
+                chat_id=DATABASE_CHAT_ID,
+                message_id=message.message_id,
+                disable_notification=True,
+                rate_limit_args=LANE_AUDIT
+            )
+            if self.pinned_message_id:
+                try:
+                    await bot.unpin_chat_message(
+                        chat_id=DATABASE_CHAT_ID, message_id=self.pinned_message_id, rate_limit_args=LANE_AUDIT
+                    )
+                except Exception as e:
+                    # The newest pin is the one get_chat reports, so a stale pin is harmless
+                    logging.error(f"Error unpinning old backup manifest: {e}")
+            self.pinned_message_id = message.message_id
             return True
         except Exception as e:
             logging.error(f"Error saving to chat: {e}")
             return False
     
+    # ---------- local snapshot cache ----------
+    def write_cached_blob(self, digest: str, blob):
+        """Keep uploaded blobs on disk, named by checksum, so restarts can skip downloads"""
+        os.makedirs(SNAPSHOT_CACHE_DIR, exist_ok=True)
+        write_file_atomic(os.path.join(SNAPSHOT_CACHE_DIR, f"{digest}.bin"), blob)
+    
+    def read_cached_blob(self, digest: str):
+        """Return a cached blob if present and its checksum holds"""
+        path = os.path.join(SNAPSHOT_CACHE_DIR, f"{digest}.bin")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            blob = f.read()
+        if hashlib.sha256(blob).hexdigest() != digest:
+            logging.warning(f"Ignoring corrupt cached snapshot {digest}")
+            return None
+        return blob
+    
+    def write_cached_manifest(self, manifest: dict):
+        """Remember the latest manifest and drop blobs it no longer references"""
+        os.makedirs(SNAPSHOT_CACHE_DIR, exist_ok=True)
+        write_file_atomic(os.path.join(SNAPSHOT_CACHE_DIR, "manifest.json"), json.dumps(manifest).encode())
+        
+        referenced = {f"{blob['sha256']}.bin" for blob in [manifest['base']] + manifest['deltas']}
+        for name in os.listdir(SNAPSHOT_CACHE_DIR):
+            if name.endswith(".bin") and name not in referenced:
+                os.remove(os.path.join(SNAPSHOT_CACHE_DIR, name))
+    
+    def write_cached_segments(self):
+        """Remember which cold segments are already in the chat"""
+        os.makedirs(SNAPSHOT_CACHE_DIR, exist_ok=True)
+        write_file_atomic(os.path.join(SNAPSHOT_CACHE_DIR, "segments.json"), json.dumps(self.segment_blobs).encode())
+    
+    def read_cached_segments(self):
+        path = os.path.join(SNAPSHOT_CACHE_DIR, "segments.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    
+    def read_cached_manifest(self):
+        path = os.path.join(SNAPSHOT_CACHE_DIR, "manifest.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    
+    # ---------- restore ----------
+    async def fetch_blob(self, blob: dict):
+        """Return a blob's bytes from the local cache, downloading its parts if needed"""
+        data = self.read_cached_blob(blob['sha256'])
+        if data is not None:
+            return data
+        data = bytearray()
+        for file_id in blob['parts']:
+            telegram_file = await self.bot.get_file(file_id)
+            data += await telegram_file.download_as_bytearray()
+        if hashlib.sha256(data).hexdigest() != blob['sha256']:
+            raise ValueError(f"Checksum mismatch for snapshot blob {blob['sha256']}")
+        self.write_cached_blob(blob['sha256'], data)
+        return data
+    
+    async def restore_chain(self, manifest: dict):
+        """Load the base snapshot and apply its deltas in order"""
+        data = decode_snapshot(await self.fetch_blob(manifest['base']))
+        # Cold segments must be on disk before the snapshot that references them
+        for name, blob in data.get('archive', {}).pop('blobs', {}).items():
+            self.storage.write_segment(name, await self.fetch_blob(blob))
+            self.segment_blobs[name] = blob
+        self.write_cached_segments()
+        self.storage.import_data(data)
+        for blob in manifest['deltas']:
+            self.storage.apply_delta(decode_snapshot(await self.fetch_blob(blob)))
+        self.storage.clear_dirty()
+        self.chain = manifest
+    
+    async def get_pinned_backup(self):
+        """Return the latest backup message: the manifest pinned in the database chat"""
+        chat = await self.bot.get_chat(DATABASE_CHAT_ID)
+        message = chat.pinned_message
+        if message and message.text and "DATABASE BACKUP" in message.text:
+            self.pinned_message_id = message.message_id
+            return message.text
+        return None
+    
     async def load_from_chat(self):
-        """Load database from chat"""
+        """Restore from the pinned backup manifest, using the local cache where it matches"""
         try:
-            if not self.bot:
+            if not self.bot or self.storage.has_local_state:
                 return
             
-            # Get messages from database chat
-            messages = []
-            async for message in self.bot.get_chat_history(chat_id=DATABASE_CHAT_ID, limit=50):
-                if "DATABASE BACKUP" in message.text:
-                    messages.append(message)
+            pinned_text = None
+            try:
+                pinned_text = await self.get_pinned_backup()
+            except Exception as e:
+                logging.error(f"Error reading pinned backup: {e}")
+            
+            # Payload is the last line: a manifest, or a legacy base64 dump
+            payload = pinned_text.rsplit('\n', 1)[-1] if pinned_text else None
+            cached = self.read_cached_manifest()
+            if cached and (not payload or not payload.startswith("{") or manifest_age(cached) > manifest_age(json.loads(payload))):
+                # A pin that failed after the upload leaves an older manifest pinned
+                manifest = cached
+                source = f"cached manifest {manifest['id']}, newer than the pinned backup"
+            elif payload and payload.startswith("{"):
+                manifest = json.loads(payload)
+                source = f"pinned manifest {manifest['id']}"
+            elif payload:
+                manifest = None
+                self.storage.import_data(json.loads(base64.b64decode(payload.encode()).decode()))
+                source = "pinned legacy backup"
+            else:
+                return
             
-            if messages:
-                # Get the latest backup
-                latest = messages[0]
-                lines = latest.text.split('\n')
-                for line in lines:
-                    if line and not line.startswith("📊") and "Time:" not in line:
-                        try:
-                            decoded_data = base64.b64decode(line.encode()).decode()
-                            loaded_data = json.loads(decoded_data)
-                            # Update self.data with loaded data
-                            for key in loaded_data:
-                                self.data[key] = loaded_data[key]
-                            
-                            # Ensure default admin is always in list
-                            if ADMIN_CHAT_ID not in self.data['admins']:
-                                self.data['admins'].append(ADMIN_CHAT_ID)
-                            
-                            # Convert used_twitter_accounts back to set
-                            if 'used_twitter_accounts' in self.data:
-                                self.data['used_twitter_accounts'] = set(self.data['used_twitter_accounts'])
-                            logging.info("Database loaded from chat successfully")
-                            break
-                        except Exception as e:
-                            logging.error(f"Error decoding data: {e}")
-                            continue
+            if manifest:
+                await self.restore_chain(manifest)
+            # Persist locally so the log has a base to replay onto
+            self.storage.compact()
+            logging.info(f"Database loaded from {source} successfully")
         except Exception as e:
             logging.error(f"Error loading from chat: {e}")
-    
-    def get_user(self, user_id: int):
-        """Get user from database"""
-        return self.data['users'].get(str(user_id))
-    
-    def create_user(self, user_id: int, username: str, first_name: str, last_name: str):
-        """Create new user if not exists"""
-        if str(user_id) not in self.data['users']:
-            self.data['users'][str(user_id)] = {
-                'user_id': user_id,
-                'username': username,
-                'first_name': first_name,
-                'last_name': last_name,
-                'balance': 0.0,
-                'total_spent': 0.0,
-                'total_purchases': 0,
-                'join_date': str(datetime.now()),
-                'last_active': str(datetime.now())
-            }
-            return True
-        return False
-    
-    def is_admin(self, user_id: int):
-        """Check if user is admin"""
-        return user_id in self.data['admins']
-    
-    def add_admin(self, user_id: int, added_by: int):
-        """Add new admin"""
-        if user_id not in self.data['admins']:
-            self.data['admins'].append(user_id)
-            return True
-        return False
-    
-    def remove_admin(self, user_id: int):
-        """Remove admin"""
-        if user_id in self.data['admins'] and user_id != ADMIN_CHAT_ID:
-            self.data['admins'].remove(user_id)
-            return True
-        return False
-    
-    def get_all_admins(self):
-        """Get all admin IDs"""
-        return self.data['admins']
-    
-    def update_twitter_price(self, new_price: float):
-        """Update Twitter account price"""
-        self.data['admin_settings']['twitter_price'] = new_price
-        return True
-    
-    def get_twitter_price(self):
-        """Get current Twitter account price"""
-        return self.data['admin_settings'].get('twitter_price', TWITTER_PRICE)
-    
-    def update_balance(self, user_id: int, amount: float, add: bool = True):
-        """Update user balance"""
-        user = self.get_user(user_id)
-        if user:
-            if add:
-                user['balance'] += amount
-            else:
-                user['balance'] -= amount
+
+# ==================== BACKUP SCHEDULER ====================
+class BackupScheduler:
+    """Coalesces database changes into at most one chat backup per interval"""
+    def __init__(self, database: ChatDatabase, interval: float = BACKUP_INTERVAL):
+        self.database = database
+        self.interval = interval
+        self.dirty = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        database.storage.on_change = self.mark_dirty
+    
+    def mark_dirty(self):
+        """Called on every mutation, so it must stay cheap"""
+        self.dirty.set()
+    
+    def start(self):
+        """Run the flush loop in the background"""
+        self.task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await self.dirty.wait()
+            # Let a burst of changes settle so it costs one snapshot
+            await asyncio.sleep(self.interval)
+            await self.flush()
+    
+    async def flush(self, force: bool = False):
+        """Back up now if anything is pending (always if forced)"""
+        async with self.lock:
+            if not force and not self.dirty.is_set():
+                return True
+            self.dirty.clear()
+            success = await self.database.checkpoint(force=force)
+            if not success:
+                self.dirty.set()  # retry on the next round
+            return success
+    
+    async def stop(self):
+        """Stop the loop and write out anything still pending"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        return await self.flush()
+
+# ==================== UPDATE PROCESSING ====================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates concurrently, but one at a time for each user"""
+    def __init__(self, max_concurrent_updates: int = CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # A lock lives while some handler holds or waits on it
+        self.user_locks = weakref.WeakValueDictionary()
+    
+    async def process_update(self, update, coroutine):
+        # The base class takes a slot before do_process_update, so updates queued behind
+        # their user's lock would hold slots and one busy user could block everyone.
+        # Wait for the user's turn first and take a slot only to run the handler.
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.slots:
+                await self.do_process_update(update, coroutine)
+            return
+        lock = self.user_locks.get(user.id)
+        if lock is None:
+            lock = self.user_locks[user.id] = asyncio.Lock()
+        async with lock:
+            async with self.slots:
+                await self.do_process_update(update, coroutine)
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# ==================== IDEMPOTENCY ====================
+class IdempotencyCache:
+    """Keys seen within the last ttl seconds, at most max_size of them"""
+    def __init__(self, ttl: float = CALLBACK_DEDUP_TTL, max_size: int = CALLBACK_DEDUP_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.seen = OrderedDict()  # key -> expiry (epoch seconds), oldest first
+        self.changed = False
+    
+    def seen_before(self, *keys: str, ttl: float = None) -> bool:
+        """True if any key was seen within its TTL; otherwise remember them all for ttl seconds"""
+        now = time.time()
+        while self.seen and next(iter(self.seen.values())) <= now:
+            self.seen.popitem(last=False)
+        # Shorter TTLs can expire behind longer ones, so check each expiry too
+        if any(self.seen.get(key, 0) > now for key in keys):
             return True
+        for key in keys:
+            self.seen.pop(key, None)
+            self.seen[key] = now + (self.ttl if ttl is None else ttl)
+        while len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+        self.changed = True
         return False
     
-    def add_twitter_account(self, username: str, password: str, email: str, added_by: int):
-        """Add Twitter account to stock"""
-        account_id = len(self.data['twitter_stock']) + 1
-        account = {
-            'id': account_id,
-            'username': username,
-            'password': password,
-            'email': email,
-            'added_by': added_by,
-            'added_date': str(datetime.now()),
-            'sold_to': None,
-            'sold_date': None,
-            'is_sold': False
-        }
-        self.data['twitter_stock'].append(account)
-        
-        # Save to chat details
-        self.save_twitter_details_to_chat(username, password, email)
-        return account_id
+    def save(self, path: str):
+        """Write the keys out so updates re-delivered after a restart are still recognised"""
+        if self.changed:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            write_file_atomic(path, json.dumps(list(self.seen.items())).encode())
+            self.changed = False
     
-    def save_twitter_details_to_chat(self, username: str, password: str, email: str):
-        """Save Twitter details to chat as separate message"""
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
         try:
-            # This would be called from admin commands
-            # The actual sending happens in the handler
-            pass
-        except:
-            pass
-    
-    def get_available_twitter_count(self):
-        """Get count of available Twitter accounts"""
-        return sum(1 for acc in self.data['twitter_stock'] if not acc['is_sold'])
-    
-    def get_twitter_accounts(self, limit: int = 20):
-        """Get available Twitter accounts"""
-        available = [acc for acc in self.data['twitter_stock'] if not acc['is_sold']]
-        return available[:limit]
-    
-    def purchase_twitter_account(self, user_id: int, quantity: int):
-        """Purchase Twitter accounts for user"""
-        available_accounts = [acc for acc in self.data['twitter_stock'] if not acc['is_sold']]
-        
-        if len(available_accounts) < quantity:
+            with open(path, encoding="utf-8") as f:
+                self.seen = OrderedDict(json.load(f))
+        except Exception as e:
+            logging.error(f"Error loading callback cache: {e}")
+
+# ==================== OUTBOUND SCHEDULER ====================
+# Lanes for outgoing Telegram calls, most urgent first; pass one as rate_limit_args
+LANE_INTERACTIVE, LANE_DELIVERY, LANE_ADMIN, LANE_AUDIT, LANE_BROADCAST = range(5)
+LANE_NAMES = ('interactive', 'delivery', 'admin', 'audit', 'broadcast')
+
+def retry_seconds(retry_after) -> float:
+    """RetryAfter.retry_after as seconds, whether an int or a timedelta"""
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+class TokenBucket:
+    """Hands out rate tokens per second, in bursts of up to capacity"""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Hand out nothing for a while, e.g. when Telegram answers RetryAfter"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.updated = self.paused_until
+        self.tokens = 0
+    
+    async def acquire(self):
+        """Wait for a token"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class OutboundScheduler(BaseRateLimiter):
+    """Releases chat-bound Bot API calls by lane, under global and per-chat rate limits"""
+    def __init__(self, rate: float = OUTBOUND_RATE, max_retries: int = OUTBOUND_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.waiting = []  # [lane, seq, chat_id, future] of calls waiting for their turn
+        self.seq = count()
+        self.chats = {}  # chat_id -> [tokens, updated]
+        self.wakeup = asyncio.Event()
+        self.task = None
+    
+    async def initialize(self):
+        self.task = asyncio.create_task(self._dispatch())
+    
+    async def shutdown(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+    
+    def queue_depths(self) -> Dict[str, int]:
+        """Calls waiting per lane, for monitoring"""
+        depths = dict.fromkeys(LANE_NAMES, 0)
+        for lane, _, _, future in self.waiting:
+            if not future.done():
+                depths[LANE_NAMES[lane]] += 1
+        return depths
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        lane = rate_limit_args if rate_limit_args is not None else LANE_INTERACTIVE
+        for attempt in range(self.max_retries + 1):
+            # Calls without a chat (answering callbacks, fetching files) are not throttled
+            if chat_id is not None:
+                await self._turn(lane, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                seconds = retry_seconds(e.retry_after)
+                logging.warning(f"Telegram asked to retry {endpoint} after {seconds}s")
+                # Flood limits count every lane, so everything waits
+                self.bucket.pause(seconds)
+                if chat_id is None:
+                    await asyncio.sleep(seconds)
+    
+    async def _turn(self, lane: int, chat_id):
+        """Wait until the dispatcher releases this call"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append([lane, next(self.seq), chat_id, future])
+        self.wakeup.set()
+        await future
+    
+    def _chat_tokens(self, chat_id, now: float) -> float:
+        rate = GROUP_CHAT_RATE if isinstance(chat_id, int) and chat_id < 0 else PRIVATE_CHAT_RATE
+        tokens, updated = self.chats.get(chat_id, (CHAT_BURST, now))
+        return min(CHAT_BURST, tokens + (now - updated) * rate), rate
+    
+    def _next_ready(self, now: float):
+        """The most urgent waiting call whose chat has a token, else None and the seconds until one does"""
+        self.waiting = [entry for entry in self.waiting if not entry[3].done()]
+        delay = None
+        for entry in sorted(self.waiting, key=lambda entry: entry[:2]):
+            tokens, rate = self._chat_tokens(entry[2], now)
+            if tokens >= 1:
+                return entry, 0
+            wait = (1 - tokens) / rate
+            delay = wait if delay is None else min(delay, wait)
+        return None, delay
+    
+    async def _dispatch(self):
+        while True:
+            self.wakeup.clear()
+            entry, delay = self._next_ready(time.monotonic())
+            if entry is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.bucket.acquire()
+            # Something more urgent may have arrived while waiting for the token
+            now = time.monotonic()
+            entry, _ = self._next_ready(now)
+            if entry is None:
+                continue
+            self.waiting.remove(entry)
+            tokens, _ = self._chat_tokens(entry[2], now)
+            self.chats[entry[2]] = [tokens - 1, now]
+            entry[3].set_result(None)
+            if len(self.chats) > 10000:
+                # Forget chats whose burst has refilled; they behave as new ones
+                self.chats = {
+                    chat_id: state for chat_id, state in self.chats.items()
+                    if self._chat_tokens(chat_id, now)[0] < CHAT_BURST
+                }
+
+# ==================== BROADCAST ENGINE ====================
+class BroadcastJob:
+    """Sends one announcement to a fixed list of users in the background"""
+    def __init__(self, state: dict):
+        # broadcast_id, text, user_ids, position (all before it are done), sent, failed,
+        # chat_id and message_id of the progress message, started_by, started_at
+        self.state = state
+        self.finished = set()  # indexes done at or after position
+        self.next_index = state['position']
+        self.task = None
+    
+    @classmethod
+    def create(cls, text: str, user_ids: List[int], started_by: int, chat_id: int, message_id: int):
+        return cls({
+            'broadcast_id': uuid.uuid4().hex[:8],
+            'text': text,
+            'user_ids': user_ids,
+            'position': 0,
+            'sent': 0,
+            'failed': 0,
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'started_by': started_by,
+            'started_at': str(datetime.now())
+        })
+    
+    @classmethod
+    def resume(cls, path: str = BROADCAST_CHECKPOINT_PATH):
+        """The job checkpointed at path, or None if no broadcast was interrupted"""
+        if not os.path.exists(path):
             return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return cls(json.load(f))
+        except Exception as e:
+            logging.error(f"Error loading broadcast checkpoint: {e}")
+            return None
+    
+    def save(self, path: str = BROADCAST_CHECKPOINT_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        write_file_atomic(path, json.dumps(self.state).encode())
+    
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    def start(self, bot):
+        self.task = asyncio.create_task(self.run(bot))
+    
+    async def stop(self):
+        """Cancel the run, leaving a checkpoint to resume from"""
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+    
+    async def run(self, bot):
+        self.save()
+        workers = [asyncio.create_task(self.worker(bot)) for _ in range(BROADCAST_CONCURRENCY)]
+        progress = asyncio.create_task(self.report_progress(bot))
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            for worker in workers:
+                worker.cancel()
+            self.save()
+            raise
+        finally:
+            progress.cancel()
         
-        purchased_accounts = []
-        current_price = self.get_twitter_price()
-        
-        for i in range(quantity):
-            account = available_accounts[i]
-            account['sold_to'] = user_id
-            account['sold_date'] = str(datetime.now())
-            account['is_sold'] = True
-            purchased_accounts.append(account.copy())
-            
-            # Mark as used
-            self.data['used_twitter_accounts'].add(account['username'])
-        
-        # Update user stats
-        user = self.get_user(user_id)
-        total_price = quantity * current_price
-        
-        if user:
-            user['balance'] -= total_price
-            user['total_spent'] += total_price
-            user['total_purchases'] += quantity
-        
-        # Create transaction record
-        transaction_id = f"TWITTER_{user_id}_{int(datetime.now().timestamp())}"
-        transaction = {
-            'transaction_id': transaction_id,
-            'user_id': user_id,
-            'amount': total_price,
-            'type': 'purchase_twitter',
-            'status': 'completed',
-            'details': f"Purchased {quantity} Twitter accounts @ ₹{current_price} each",
-            'created_at': str(datetime.now()),
-            'completed_at': str(datetime.now())
-        }
-        self.data['transactions'].append(transaction)
-        
-        return purchased_accounts
-    
-    def create_payment(self, payment_id: str, user_id: int):
-        """Create payment record"""
-        payment = {
-            'payment_id': payment_id,
-            'user_id': user_id,
-            'amount': None,
-            'utr': None,
-            'status': 'pending',
-            'qr_sent': True,
-            'created_at': str(datetime.now()),
-            'verified_at': None,
-            'verified_by': None
-        }
-        self.data['payments'].append(payment)
-        return payment
-    
-    def update_payment_utr(self, payment_id: str, utr: str):
-        """Update payment with UTR"""
-        for payment in self.data['payments']:
-            if payment['payment_id'] == payment_id:
-                payment['utr'] = utr
-                payment['status'] = 'pending_verification'
-                return True
-        return False
+        os.remove(BROADCAST_CHECKPOINT_PATH)
+        await self.edit_progress(bot, done=True)
+        await bot.send_message(
+            chat_id=self.state['chat_id'],
+            text=f"""
+✅ *Broadcast Completed!*
+
+*Total Users:* {len(self.state['user_ids'])}
+*Successful:* {self.state['sent']}
+*Failed:* {self.state['failed']}
+*Completion Time:* {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+
+*Note:* Failed messages may be due to users blocking the bot.
+            """,
+            parse_mode=ParseMode.MARKDOWN,
+            rate_limit_args=LANE_ADMIN
+        )
     
-    def verify_payment(self, payment_id: str, amount: float, verified_by: int):
-        """Verify a payment"""
-        for payment in self.data['payments']:
-            if payment['payment_id'] == payment_id:
-                payment['status'] = 'verified'
-                payment['amount'] = amount
-                payment['verified_at'] = str(datetime.now())
-                payment['verified_by'] = verified_by
-                
-                # Update user balance
-                self.update_balance(payment['user_id'], amount)
-                
-                # Create transaction record
-                transaction_id = f"PAYMENT_{payment['user_id']}_{int(datetime.now().timestamp())}"
-                transaction = {
-                    'transaction_id': transaction_id,
-                    'user_id': payment['user_id'],
-                    'amount': amount,
-                    'type': 'add_funds',
-                    'status': 'completed',
-                    'details': f"Payment via UTR: {payment.get('utr', 'N/A')}",
-                    'created_at': str(datetime.now()),
-                    'completed_at': str(datetime.now())
-                }
-                self.data['transactions'].append(transaction)
+    async def worker(self, bot):
+        user_ids = self.state['user_ids']
+        while self.next_index < len(user_ids):
+            index = self.next_index
+            self.next_index += 1
+            if await self.send(bot, user_ids[index]):
+                self.state['sent'] += 1
+            else:
+                self.state['failed'] += 1
+            # Move the checkpoint past every index finished so far without gaps
+            self.finished.add(index)
+            while self.state['position'] in self.finished:
+                self.finished.remove(self.state['position'])
+                self.state['position'] += 1
+    
+    async def send(self, bot, user_id: int) -> bool:
+        """Deliver to one user; False if they cannot be reached"""
+        attempts = 0
+        while True:
+            try:
+                await bot.send_message(
+                    chat_id=user_id, text=self.state['text'], parse_mode=ParseMode.MARKDOWN,
+                    rate_limit_args=LANE_BROADCAST
+                )
                 return True
-        return False
-    
-    def get_admin_setting(self, key: str):
-        """Get admin setting"""
-        return self.data['admin_settings'].get(key)
-    
-    def set_admin_setting(self, key: str, value: str):
-        """Set admin setting"""
-        self.data['admin_settings'][key] = value
+            except RetryAfter as e:
+                # The scheduler already retried; keep this user and try again later
+                await asyncio.sleep(retry_seconds(e.retry_after))
+            except (Forbidden, BadRequest) as e:
+                logging.error(f"Error sending broadcast to {user_id}: {e}")
+                return False
+            except NetworkError as e:
+                attempts += 1
+                if attempts >= BROADCAST_RETRIES:
+                    logging.error(f"Error sending broadcast to {user_id}: {e}")
+                    return False
+                await asyncio.sleep(2 ** attempts)
+            except Exception as e:
+                logging.error(f"Error sending broadcast to {user_id}: {e}")
+                return False
+    
+    async def report_progress(self, bot):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                self.save()
+            except Exception as e:
+                logging.error(f"Error saving broadcast checkpoint: {e}")
+            await self.edit_progress(bot)
+    
+    async def edit_progress(self, bot, done: bool = False):
+        total = len(self.state['user_ids'])
+        finished = self.state['sent'] + self.state['failed']
+        try:
+            await bot.edit_message_text(
+                chat_id=self.state['chat_id'],
+                message_id=self.state['message_id'],
+                text=f"""
+📢 *Broadcast {'Finished' if done else 'Running'}*
+
+*Progress:* {finished}/{total} ({finished * 100 // max(total, 1)}%)
+*Successful:* {self.state['sent']}
+*Failed:* {self.state['failed']}
+*Started:* {self.state['started_at'][:19]}
+                """,
+                parse_mode=ParseMode.MARKDOWN,
+                rate_limit_args=LANE_ADMIN
+            )
+        except Exception as e:
+            logging.error(f"Error updating broadcast progress: {e}")
+
+# ==================== AUDIT LOG ====================
+class AuditLog:
+    """Queues audit events for the database chat and sends them in packed batches"""
+    def __init__(self, interval: float = AUDIT_FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending = deque()  # (text, document or None), oldest first
+        self.ready = asyncio.Event()
+        self.task = None
+        self.bot = None
+        self.dropped = 0  # events lost to a full queue since the last flush
+    
+    def add(self, text: str, document: InputFile = None):
+        """Queue an event; never waits on the network"""
+        if len(self.pending) >= AUDIT_MAX_PENDING:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append((text.strip(), document))
+        self.ready.set()
+    
+    def start(self, bot):
+        """Run the send loop in the background"""
+        self.bot = bot
+        self.task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await self.ready.wait()
+            # Let a burst of events settle so they share messages
+            await asyncio.sleep(self.interval)
+            await self.flush()
+    
+    async def flush(self):
+        """Send everything queued so far, in order; False if the chat could not be reached"""
+        self.ready.clear()
+        if self.dropped:
+            logging.error(f"Audit queue was full, dropped {self.dropped} oldest events")
+            self.dropped = 0
+        while self.pending:
+            text, document = self.pending[0]
+            texts = [entry[0] for entry in takewhile(lambda entry: entry[1] is None, self.pending)]
+            try:
+                if document is not None:
+                    await self.bot.send_document(
+                        chat_id=DATABASE_CHAT_ID, document=document, caption=text[:1024], rate_limit_args=LANE_AUDIT
+                    )
+                    sent = 1
+                elif sum(len(text) for text in texts) > AUDIT_DOCUMENT_MIN_CHARS or len(texts[0]) > MESSAGE_MAX_CHARS:
+                    await self.bot.send_document(
+                        chat_id=DATABASE_CHAT_ID,
+                        document=InputFile("\n\n".join(texts).encode("utf-8"), filename=f"audit_{datetime.now():%Y%m%d_%H%M%S}.txt"),
+                        caption=f"🗂 {len(texts)} audit events",
+                        rate_limit_args=LANE_AUDIT
+                    )
+                    sent = len(texts)
+                else:
+                    packed, sent = pack_messages([text + "\n" for text in texts])[0]
+                    await self.send_text(packed)
+            except BadRequest as e:
+                logging.error(f"Dropping audit event Telegram rejected: {e}")
+                sent = 1
+            except Exception as e:
+                logging.error(f"Error saving to database chat: {e}")
+                self.ready.set()  # retry on the next round
+                return False
+            for _ in range(sent):
+                self.pending.popleft()
         return True
     
-    def get_statistics(self):
-        """Get bot statistics"""
-        user_count = len(self.data['users'])
-        total_balance = sum(user['balance'] for user in self.data['users'].values())
-        total_sales = sum(t['amount'] for t in self.data['transactions'] if t['type'] == 'purchase_twitter')
-        total_stock = len(self.data['twitter_stock'])
-        sold_stock = sum(1 for acc in self.data['twitter_stock'] if acc['is_sold'])
-        available_stock = total_stock - sold_stock
-        admin_count = len(self.data['admins'])
-        current_price = self.get_twitter_price()
-        
-        recent_transactions = sorted(
-            self.data['transactions'],
-            key=lambda x: x.get('created_at', ''),
-            reverse=True
-        )[:10]
-        
-        return {
-            'user_count': user_count,
-            'total_balance': total_balance,
-            'total_sales': total_sales,
-            'total_stock': total_stock,
-            'sold_stock': sold_stock,
-            'available_stock': available_stock,
-            'admin_count': admin_count,
-            'current_price': current_price,
-            'recent_transactions': recent_transactions
-        }
-    
-    def get_all_users(self):
-        """Get all user IDs"""
-        return [int(user_id) for user_id in self.data['users'].keys()]
+    async def send_text(self, text: str):
+        try:
+            await self.bot.send_message(
+                chat_id=DATABASE_CHAT_ID, text=text, parse_mode=ParseMode.MARKDOWN, rate_limit_args=LANE_AUDIT
+            )
+        except BadRequest:
+            # Usually Markdown that does not parse once events are joined; plain text always does
+            await self.bot.send_message(chat_id=DATABASE_CHAT_ID, text=text, rate_limit_args=LANE_AUDIT)
+    
+    async def stop(self):
+        """Stop the loop and send anything still queued"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.bot:
+            return await self.flush()
+        return True
+
+# ==================== HOUSEKEEPING ====================
+async def housekeeping():
+    """Return stock and funds held by abandoned checkouts and save the callback cache"""
+    while True:
+        await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+        try:
+            released = db.expire_reservations()
+            if released:
+                logging.info(f"Released {released} expired reservations")
+        except Exception as e:
+            logging.error(f"Error sweeping reservations: {e}")
+        try:
+            callback_cache.save(CALLBACK_CACHE_PATH)
+        except Exception as e:
+            logging.error(f"Error saving callback cache: {e}")
 
 # Initialize database (will be set after bot is initialized)
 db = None
+backup_scheduler = None
+housekeeping_task = None
+callback_cache = IdempotencyCache()
+outbound = OutboundScheduler()
+audit_log = AuditLog()
+broadcast_job = None
+
+# ==================== CALLBACK DATA ====================
+CALLBACK_DATA_MAX = 64  # bytes Telegram allows in a button's callback_data
+CB_MAIN_MENU, CB_BUY, CB_CHECK_PAYMENT = "m", "b", "p"
+CALLBACK_ARG_TYPES = {CB_MAIN_MENU: None, CB_BUY: int, CB_CHECK_PAYMENT: str}  # action -> argument type
+# Buttons sent before the codec existed are still on users' screens
+LEGACY_CALLBACKS = (("main_menu", CB_MAIN_MENU), ("buy_twitter_", CB_BUY), ("check_payment_", CB_CHECK_PAYMENT))
+
+def encode_callback(action: str, arg=None) -> str:
+    """callback_data for an action and its argument, as "action:arg" """
+    data = action if arg is None else f"{action}:{arg}"
+    if len(data.encode("utf-8")) > CALLBACK_DATA_MAX:
+        raise ValueError(f"Callback data longer than {CALLBACK_DATA_MAX} bytes: {data}")
+    return data
+
+def decode_callback(data: str) -> Tuple[Optional[str], object]:
+    """(action, typed argument) from callback_data, or (None, None) if it is not ours"""
+    action, _, arg = data.partition(":")
+    if action not in CALLBACK_ARG_TYPES:
+        for prefix, legacy_action in LEGACY_CALLBACKS:
+            if data.startswith(prefix):
+                action, arg = legacy_action, data[len(prefix):]
+                break
+        else:
+            return None, None
+    arg_type = CALLBACK_ARG_TYPES[action]
+    if arg_type is None:
+        return action, None
+    try:
+        return action, arg_type(arg)
+    except ValueError:
+        return None, None
+
+def is_check_payment(data: str) -> bool:
+    return decode_callback(data)[0] == CB_CHECK_PAYMENT
 
 # ==================== HELPER FUNCTIONS ====================
-async def save_to_database_chat(context: ContextTypes.DEFAULT_TYPE, text: str):
-    """Send data to database chat for storage"""
-    try:
-        await context.bot.send_message(
-            chat_id=DATABASE_CHAT_ID,
-            text=text,
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return True
-    except Exception as e:
-        logging.error(f"Error saving to database chat: {e}")
+def save_to_database_chat(context: ContextTypes.DEFAULT_TYPE, text: str, document: InputFile = None):
+    """Queue data for the database chat, optionally as a document captioned with text"""
+    # Sent in the background by audit_log, so handlers never wait on it
+    audit_log.add(text, document)
+    return True
+
+async def save_database_backup(context: ContextTypes.DEFAULT_TYPE, force: bool = False):
+    """Queue a chat backup; only a forced backup waits for the upload"""
+    if not backup_scheduler:
         return False
-
-async def save_database_backup(context: ContextTypes.DEFAULT_TYPE):
-    """Save entire database to chat"""
-    if db:
-        await db.save_to_chat(context)
+    if force:
+        return await backup_scheduler.flush(force=True)
+    backup_scheduler.mark_dirty()
+    return True
 
 def generate_qr_code(data: str):
     """Generate QR code image"""
@@ -409,8 +1061,39 @@ def generate_qr_code(data: str):
     bio.seek(0)
     return bio
 
+def pack_messages(lines: List[str], header: str = "", footer: str = "", limit: int = MESSAGE_MAX_CHARS):
+    """Group lines into as few messages under limit as possible; returns (text, line count) pairs"""
+    messages = []
+    chunk = []
+    size = len(header) + len(footer)
+    for line in lines:
+        if chunk and size + len(line) + 1 > limit:
+            messages.append((header + "\n".join(chunk), len(chunk)))
+            chunk = []
+            size = len(header) + len(footer)
+        chunk.append(line)
+        size += len(line) + 1
+    messages.append((header + "\n".join(chunk) + footer, len(chunk)))
+    return messages
+
+def accounts_csv(accounts: List[dict]) -> bytes:
+    """Accounts as a CSV file with a username,password,email header"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["username", "password", "email"])
+    writer.writerows([acc['username'], acc['password'], acc['email']] for acc in accounts)
+    return buf.getvalue().encode("utf-8")
+
+ACCOUNT_INSTRUCTIONS = """*Instructions:*
+1. Login at twitter.com
+2. Change password immediately
+3. Enable 2FA for security
+
+*Note:* Each account is for one-time use only"""
+
+@lru_cache(maxsize=None)
 def create_main_menu():
-    """Create main menu keyboard"""
+    """Create main menu keyboard, built once; Telegram objects are immutable so it is shared"""
     keyboard = [
         [KeyboardButton("💰 Add Funds"), KeyboardButton("🐦 Buy Twitter")],
         [KeyboardButton("📊 Check Balance"), KeyboardButton("📦 Stock")],
@@ -418,20 +1101,91 @@ def create_main_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
+@lru_cache(maxsize=None)
 def create_twitter_quantity_menu():
-    """Create Twitter quantity selection menu"""
+    """Create Twitter quantity selection menu, built once"""
     keyboard = []
     for i in range(0, 20, 4):
         row = []
         for j in range(1, 5):
             if i + j <= 20:
-                row.append(InlineKeyboardButton(f"Twitter {i+j}", callback_data=f"buy_twitter_{i+j}"))
+                row.append(InlineKeyboardButton(f"Twitter {i+j}", callback_data=encode_callback(CB_BUY, i + j)))
         if row:
             keyboard.append(row)
     
-    keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")])
+    keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data=encode_callback(CB_MAIN_MENU))])
     return InlineKeyboardMarkup(keyboard)
 
+# ==================== RENDER CACHE ====================
+class RenderCache:
+    """Last rendered body of each screen, kept while the storage's catalog_version is unchanged"""
+    def __init__(self):
+        self.screens = {}  # name -> (version, body)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, name: str, render):
+        """Cached body of a screen; render() reads storage only when stock, price or settings changed"""
+        version = db.catalog_version
+        cached = self.screens.get(name)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        body = render()
+        self.screens[name] = (version, body)
+        return body
+
+def render_buy_twitter() -> Optional[str]:
+    """Quantity menu text, or None when nothing is in stock"""
+    available = db.get_available_twitter_count()
+    if available == 0:
+        return None
+    price = db.get_twitter_price()
+    return f"""
+🐦 *Buy Twitter Accounts*
+
+*Available in stock:* {available} accounts
+*Price:* ₹{price} per account
+
+Select quantity to purchase:
+    """
+
+def render_stock() -> str:
+    available = db.get_available_twitter_count()
+    price = db.get_twitter_price()
+    return f"""
+📦 *Stock Information*
+
+*Twitter Accounts Available:* {available}
+*Price per account:* ₹{price}
+*Status:* {'✅ In Stock' if available > 0 else '❌ Out of Stock'}
+
+{'*Note:* Stock updates automatically when admin adds new accounts.' if available > 0 else '*Note:* Please wait 24 hours for stock update or contact admin.'}
+    """
+
+CONTACT_MESSAGE = """
+📞 *Contact & Support*
+
+Hi dear,
+
+If you need any help, have any queries, or face any issues, please DM me:
+
+👉 *@KILLERxVIPP*
+
+I will help you resolve your problems as soon as possible.
+
+*Common Issues:*
+• Payment verification
+• Account delivery
+• Balance issues
+• Technical problems
+
+*Response Time:* Usually within 1-2 hours
+    """
+
+render_cache = RenderCache()
+
 # ==================== BOT COMMAND HANDLERS ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -439,7 +1193,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.create_user(user.id, user.username, user.first_name, user.last_name)
     
     # Save user details to database chat
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 👤 NEW USER REGISTERED
 User ID: `{user.id}`
 Username: @{user.username}
@@ -472,18 +1226,9 @@ Time: {datetime.now()}
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle regular messages (button clicks)"""
-    text = update.message.text
-    
-    if text == "💰 Add Funds":
-        await add_funds(update, context)
-    elif text == "🐦 Buy Twitter":
-        await buy_twitter_menu(update, context)
-    elif text == "📊 Check Balance":
-        await check_balance(update, context)
-    elif text == "📦 Stock":
-        await check_stock(update, context)
-    elif text == "📞 Contact":
-        await contact_us(update, context)
+    handler = BUTTON_ROUTES.get(update.message.text)
+    if handler:
+        await handler(update, context)
 
 # ==================== BUTTON FUNCTION HANDLERS ====================
 async def add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -504,7 +1249,7 @@ async def add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Create payment record
     db.create_payment(payment_id, update.effective_user.id)
     
-    keyboard = [[InlineKeyboardButton("✅ Check Payment", callback_data=f"check_payment_{payment_id}")]]
+    keyboard = [[InlineKeyboardButton("✅ Check Payment", callback_data=encode_callback(CB_CHECK_PAYMENT, payment_id))]]
     
     await update.message.reply_photo(
         photo=qr_image_id,
@@ -524,7 +1269,7 @@ async def add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Save to database chat
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 💸 PAYMENT INITIATED
 User ID: `{update.effective_user.id}`
 Payment ID: `{payment_id}`
@@ -534,25 +1279,15 @@ Status: Pending
 
 async def buy_twitter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show Twitter quantity selection menu"""
-    available = db.get_available_twitter_count()
-    current_price = db.get_twitter_price()
+    message = render_cache.get('buy_twitter', render_buy_twitter)
     
-    if available == 0:
+    if message is None:
         await update.message.reply_text(
             "❌ No Twitter accounts available in stock.\nPlease wait 24 hours or contact admin.",
             reply_markup=create_main_menu()
         )
         return
     
-    message = f"""
-🐦 *Buy Twitter Accounts*
-
-*Available in stock:* {available} accounts
-*Price:* ₹{current_price} per account
-
-Select quantity to purchase:
-    """
-    
     if update.message:
         await update.message.reply_text(
             message,
@@ -578,15 +1313,7 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Get user transactions
-    user_transactions = [
-        t for t in db.data['transactions'] 
-        if t['user_id'] == user['user_id']
-    ]
-    recent_transactions = sorted(
-        user_transactions,
-        key=lambda x: x.get('created_at', ''),
-        reverse=True
-    )[:5]
+    recent_transactions = db.get_user_transactions(user['user_id'], limit=5)
     
     # Format transactions
     trans_text = "\n".join([
@@ -620,18 +1347,7 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def check_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle Stock button"""
-    available = db.get_available_twitter_count()
-    current_price = db.get_twitter_price()
-    
-    message = f"""
-📦 *Stock Information*
-
-*Twitter Accounts Available:* {available}
-*Price per account:* ₹{current_price}
-*Status:* {'✅ In Stock' if available > 0 else '❌ Out of Stock'}
-
-{'*Note:* Stock updates automatically when admin adds new accounts.' if available > 0 else '*Note:* Please wait 24 hours for stock update or contact admin.'}
-    """
+    message = render_cache.get('stock', render_stock)
     
     await update.message.reply_text(
         message,
@@ -641,85 +1357,93 @@ async def check_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def contact_us(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle Contact button"""
-    message = """
-📞 *Contact & Support*
-
-Hi dear,
-
-If you need any help, have any queries, or face any issues, please DM me:
-
-👉 *@KILLERxVIPP*
-
-I will help you resolve your problems as soon as possible.
-
-*Common Issues:*
-• Payment verification
-• Account delivery
-• Balance issues
-• Technical problems
-
-*Response Time:* Usually within 1-2 hours
-    """
-    
     await update.message.reply_text(
-        message,
+        CONTACT_MESSAGE,
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=create_main_menu()
     )
 
+# Reply keyboard label -> handler
+BUTTON_ROUTES = {
+    "💰 Add Funds": add_funds,
+    "🐦 Buy Twitter": buy_twitter_menu,
+    "📊 Check Balance": check_balance,
+    "📦 Stock": check_stock,
+    "📞 Contact": contact_us
+}
+
 # ==================== CALLBACK QUERY HANDLERS ====================
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle callback queries from inline buttons"""
     query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    
-    if data == "main_menu":
-        await query.message.delete()
-        await query.message.reply_text(
-            "Main Menu",
-            reply_markup=create_main_menu()
-        )
+    action, arg = decode_callback(query.data)
+    
+    # Double taps, client retries and re-delivered updates stop here, before any work
+    if action in (CB_BUY, CB_CHECK_PAYMENT):
+        duplicate = callback_cache.seen_before(f"query:{query.id}")
+        if not duplicate and query.message:
+            # A buy button is replaced once used, so any second tap on it is a double tap, however
+            # long the first delivery took. Check Payment stays usable after a rejected UTR, so a
+            # second tap on it is only a double tap for a few seconds.
+            duplicate = callback_cache.seen_before(
+                f"message:{query.message.chat.id}:{query.message.message_id}:{query.data}",
+                ttl=CALLBACK_DOUBLE_TAP_WINDOW if action == CB_CHECK_PAYMENT else None
+            )
+        if duplicate:
+            try:
+                await query.answer()  # stop the client's spinner
+            except BadRequest:
+                pass  # a re-delivered query was already answered
+            return None
     
-    elif data.startswith("buy_twitter_"):
-        quantity = int(data.split("_")[2])
-        await purchase_twitter_accounts(query, context, quantity)
+    await query.answer()
     
-    elif data.startswith("check_payment_"):
-        payment_id = data.split("_")[2]
-        await verify_payment(query, context, payment_id)
+    handler = CALLBACK_ROUTES.get(action)
+    if handler:
+        return await handler(query, context, arg)
+    return None
+
+async def show_main_menu(query, context, _=None):
+    """Replace the inline menu with the main reply keyboard"""
+    await query.message.delete()
+    await query.message.reply_text(
+        "Main Menu",
+        reply_markup=create_main_menu()
+    )
 
 async def purchase_twitter_accounts(query, context, quantity: int):
     """Process Twitter account purchase"""
     user_id = query.from_user.id
-    user = db.get_user(user_id)
-    
     current_price = db.get_twitter_price()
     total_price = quantity * current_price
     
+    # Check balance and stock and hold both in one step, so a second tap cannot spend them again
+    reservation, problem = db.reserve(user_id, quantity)
+    
     # Check balance
-    if user['balance'] < total_price:
+    if problem == 'balance':
+        user = db.get_user(user_id)
+        balance = user['balance'] if user else 0
         await query.message.edit_text(
             f"""
 ❌ *Insufficient Balance*
 
 *Required:* ₹{total_price}
-*Your Balance:* ₹{user['balance']:.2f}
-*Short by:* ₹{total_price - user['balance']:.2f}
+*Your Balance:* ₹{balance:.2f}
+*Short by:* ₹{total_price - balance:.2f}
 
 Please add funds first.
             """,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Add Funds", callback_data="main_menu")]
+                [InlineKeyboardButton("💰 Add Funds", callback_data=encode_callback(CB_MAIN_MENU))]
             ])
         )
         return
     
     # Check stock
-    available = db.get_available_twitter_count()
-    if available < quantity:
+    if problem == 'stock':
+        available = db.get_available_twitter_count()
         await query.message.edit_text(
             f"""
 ❌ *Insufficient Stock*
@@ -734,35 +1458,105 @@ Please wait 24 hours or reduce quantity.
         )
         return
     
-    # Process purchase
-    purchased_accounts = db.purchase_twitter_account(user_id, quantity)
+    if not reservation:
+        await query.message.edit_text(
+            "❌ Purchase failed. Please try again.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    
+    # Deliver first, then charge only for what arrived; only this user's lock is held meanwhile.
+    # Accounts are packed into as few messages as fit, or one CSV file for large orders.
+    # The hold is pinned so a slow delivery cannot expire and put sent accounts back on sale.
+    db.pin_reservation(reservation['reservation_id'])
+    accounts = reservation['accounts']
+    delivered = 0
+    try:
+        if len(accounts) >= DELIVERY_DOCUMENT_MIN:
+            await context.bot.send_document(
+                chat_id=user_id,
+                document=InputFile(accounts_csv(accounts), filename=f"twitter_accounts_{reservation['reservation_id']}.csv"),
+                caption=f"🐦 *{len(accounts)} Twitter Accounts* (username, password, email)\n\n{ACCOUNT_INSTRUCTIONS}",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=create_main_menu(),
+                rate_limit_args=LANE_DELIVERY
+            )
+            delivered = len(accounts)
+        else:
+            messages = pack_messages(
+                [f"{i}. `{acc['username']}` | `{acc['password']}` | `{acc['email']}`" for i, acc in enumerate(accounts, 1)],
+                header=f"🐦 *Your {len(accounts)} Twitter Accounts*\n_username | password | email_\n\n",
+                footer=f"\n\n{ACCOUNT_INSTRUCTIONS}\n\n🎉 Thank you for your purchase!"
+            )
+            for n, (text, count) in enumerate(messages, 1):
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    text=text,
+                    parse_mode=ParseMode.MARKDOWN,
+                    reply_markup=create_main_menu() if n == len(messages) else None,
+                    rate_limit_args=LANE_DELIVERY
+                )
+                delivered += count
+    except Exception as e:
+        logging.error(f"Error delivering reservation {reservation['reservation_id']}: {e}")
+    
+    purchased_accounts = db.commit_reservation(reservation['reservation_id'], delivered)
+    if purchased_accounts is None:
+        # Pinned holds do not expire, so only a restart or a bulk import gets here
+        logging.error(f"Reservation {reservation['reservation_id']} was gone after delivering {delivered} accounts")
+        purchased_accounts = []
+    
+    if delivered and not purchased_accounts:
+        await query.message.edit_text(
+            "⚠️ Your accounts were sent above, but the purchase could not be recorded. Please contact @KILLERxVIPP.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
     
     if not purchased_accounts:
         await query.message.edit_text(
-            "❌ Purchase failed. Please try again.",
+            "❌ Delivery failed. You have not been charged. Please try again.",
             parse_mode=ParseMode.MARKDOWN
         )
         return
     
-    # Save purchase to database chat
-    account_details = []
-    for acc in purchased_accounts:
-        account_details.append(f"Username: {acc['username']} | Pass: {acc['password']} | Email: {acc['email']}")
+    quantity = len(purchased_accounts)
+    total_price = quantity * reservation['price']
     
-    await save_to_database_chat(context, f"""
+    # Re-read the user so the new balance is shown
+    user = db.get_user(user_id)
+    
+    # Save purchase to database chat; large orders attach the accounts as a file
+    summary = f"""
 🐦 TWITTER ACCOUNTS SOLD
 ━━━━━━━━━━━━━━━━━━━━━━
 👤 User: {user_id} (@{user['username']})
 📦 Quantity: {quantity} accounts
 💰 Total: ₹{total_price}
 ⏰ Time: {datetime.now()}
-━━━━━━━━━━━━━━━━━━━━━━
+━━━━━━━━━━━━━━━━━━━━━━"""
+    if quantity >= DELIVERY_DOCUMENT_MIN:
+        save_to_database_chat(context, summary, document=InputFile(
+            accounts_csv(purchased_accounts), filename=f"sold_{reservation['reservation_id']}.csv"
+        ))
+    else:
+        account_details = []
+        for acc in purchased_accounts:
+            account_details.append(f"Username: {acc['username']} | Pass: {acc['password']} | Email: {acc['email']}")
+        
+        save_to_database_chat(context, f"""{summary}
 Accounts Sold:
 {chr(10).join(account_details)}
 ━━━━━━━━━━━━━━━━━━━━━━
     """)
     
     # Send success message
+    shortfall = len(reservation['accounts']) - quantity
+    delivery_note = (
+        f"⚠️ {shortfall} accounts could not be delivered and were not charged." if shortfall
+        else "*Your accounts have been sent below.*"
+    )
+    # Only one status edit; the delivery itself carries the thanks and the main menu
     await query.message.edit_text(
         f"""
 ✅ *Purchase Successful!*
@@ -772,38 +1566,10 @@ Accounts Sold:
 *New Balance:* ₹{user['balance']:.2f}
 *Transaction Time:* {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
-*Your accounts will be sent in the next message...*
+{delivery_note}
         """,
         parse_mode=ParseMode.MARKDOWN
     )
-    
-    # Send accounts individually
-    for i, acc in enumerate(purchased_accounts, 1):
-        account_message = f"""
-🐦 *Twitter Account {i}/{quantity}*
-
-*Username:* `{acc['username']}`
-*Password:* `{acc['password']}`
-*Email:* `{acc['email']}`
-
-*Instructions:*
-1. Login at twitter.com
-2. Change password immediately
-3. Enable 2FA for security
-
-*Note:* This account is for one-time use only
-        """
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=account_message,
-            parse_mode=ParseMode.MARKDOWN
-        )
-    
-    await context.bot.send_message(
-        chat_id=user_id,
-        text=f"🎉 All {quantity} accounts delivered! Thank you for your purchase.",
-        reply_markup=create_main_menu()
-    )
 
 async def verify_payment(query, context, payment_id):
     """Handle payment verification"""
@@ -823,14 +1589,21 @@ Example: `123456789012345`
     
     # Store payment ID in context for next message
     context.user_data['awaiting_utr'] = payment_id
+    return WAITING_FOR_PAYMENT_VERIFICATION
+
+# Callback action -> handler(query, context, argument)
+CALLBACK_ROUTES = {
+    CB_MAIN_MENU: show_main_menu,
+    CB_BUY: purchase_twitter_accounts,
+    CB_CHECK_PAYMENT: verify_payment
+}
 
 # ==================== PAYMENT VERIFICATION HANDLER ====================
 async def handle_utr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle UTR input for payment verification"""
-    if 'awaiting_utr' not in context.user_data:
-        return
-    
-    payment_id = context.user_data['awaiting_utr']
+    payment_id = context.user_data.pop('awaiting_utr', None)
+    if not payment_id:
+        return ConversationHandler.END
     utr = update.message.text.strip()
     
     # Validate UTR format
@@ -839,15 +1612,37 @@ async def handle_utr(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "❌ Invalid UTR format. Please enter a valid numeric UTR/Transaction ID.",
             reply_markup=create_main_menu()
         )
-        del context.user_data['awaiting_utr']
-        return
+        return ConversationHandler.END
+    
+    # A UTR can only pay for one payment
+    user = update.effective_user
+    existing = db.get_payment_by_utr(utr)
+    if existing and existing['payment_id'] != payment_id:
+        await update.message.reply_text(
+            "❌ This UTR has already been submitted for another payment. Please check it or contact @KILLERxVIPP.",
+            reply_markup=create_main_menu()
+        )
+        await context.bot.send_message(
+            chat_id=ADMIN_CHAT_ID,
+            text=f"""
+⚠️ *Reused UTR Rejected*
+
+*User:* {user.first_name} (@{user.username})
+*User ID:* `{user.id}`
+*Payment ID:* `{payment_id}`
+*UTR:* `{utr}`
+*Already used by:* `{existing['payment_id']}` (user `{existing['user_id']}`, {existing['status']})
+            """,
+            parse_mode=ParseMode.MARKDOWN,
+            rate_limit_args=LANE_ADMIN
+        )
+        return ConversationHandler.END
     
     # Update payment record with UTR
     db.update_payment_utr(payment_id, utr)
     
     # Save to database chat
-    user = update.effective_user
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 💳 PAYMENT UTR RECEIVED
 ━━━━━━━━━━━━━━━━━━━━━━
 👤 User: {user.id} (@{user.username})
@@ -872,8 +1667,8 @@ Your payment is under verification. This usually takes 2-5 minutes.
         """,
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Retry Payment", callback_data=f"check_payment_{payment_id}")],
-            [InlineKeyboardButton("📞 Contact Support", callback_data="main_menu")]
+            [InlineKeyboardButton("🔄 Retry Payment", callback_data=encode_callback(CB_CHECK_PAYMENT, payment_id))],
+            [InlineKeyboardButton("📞 Contact Support", callback_data=encode_callback(CB_MAIN_MENU))]
         ])
     )
     
@@ -891,10 +1686,11 @@ Your payment is under verification. This usually takes 2-5 minutes.
 
 *To verify:* Check payment and use /verify {payment_id} <amount>
         """,
-        parse_mode=ParseMode.MARKDOWN
+        parse_mode=ParseMode.MARKDOWN,
+        rate_limit_args=LANE_ADMIN
     )
     
-    del context.user_data['awaiting_utr']
+    return ConversationHandler.END
 
 # ==================== ADMIN COMMANDS ====================
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -958,6 +1754,11 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Example: `/broadcast Hello users!`
     *Send message to all users*
 
+11. *Sales Report:*
+    `/report <from> <to>`
+    Example: `/report 2024-01-01 2024-01-31`
+    *Daily totals for dates, hourly for date and time*
+
 *Admin Panel will remain active for this session.*
     """
     
@@ -999,7 +1800,7 @@ async def add_new_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if success:
         # Save to database chat
-        await save_to_database_chat(context, f"""
+        save_to_database_chat(context, f"""
 👑 NEW ADMIN ADDED
 ━━━━━━━━━━━━━━━━━━━━━━
 🆔 New Admin ID: {new_admin_id}
@@ -1044,7 +1845,8 @@ Congratulations! You have been added as an admin by {update.effective_user.id}.
 
 Use `/adminpanel {ADMIN_PASSWORD}` to access admin panel.
                 """,
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=ParseMode.MARKDOWN,
+                rate_limit_args=LANE_ADMIN
             )
         except Exception as e:
             logging.error(f"Error notifying new admin: {e}")
@@ -1080,7 +1882,7 @@ async def change_twitter_price(update: Update, context: ContextTypes.DEFAULT_TYP
     db.update_twitter_price(new_price)
     
     # Save to database chat
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 💰 TWITTER PRICE CHANGED
 ━━━━━━━━━━━━━━━━━━━━━━
 👨‍💼 Changed by: {update.effective_user.id}
@@ -1116,6 +1918,11 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /broadcast <message>\nExample: /broadcast Hello users!")
         return
     
+    global broadcast_job
+    if broadcast_job and broadcast_job.running:
+        await update.message.reply_text("⏳ A broadcast is already running. Wait for it to finish.")
+        return
+    
     message = ' '.join(context.args)
     all_users = db.get_all_users()
     
@@ -1123,7 +1930,7 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ No users found in database.")
         return
     
-    await update.message.reply_text(
+    progress_message = await update.message.reply_text(
         f"""
 📢 *Broadcast Started*
 
@@ -1138,7 +1945,7 @@ Sending messages to all users...
     )
     
     # Save to database chat
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 📢 BROADCAST MESSAGE
 ━━━━━━━━━━━━━━━━━━━━━━
 👨‍💼 Sent by: {update.effective_user.id}
@@ -1149,15 +1956,9 @@ Message: {message}
 ━━━━━━━━━━━━━━━━━━━━━━
     """)
     
-    # Send to all users
-    success_count = 0
-    fail_count = 0
-    
-    for user_id in all_users:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"""
+    # Send in the background; progress is edited into the message above
+    broadcast_job = BroadcastJob.create(
+        f"""
 📢 *Announcement from Admin*
 
 {message}
@@ -1165,34 +1966,10 @@ Message: {message}
 *Time:* {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
 _This is an automated broadcast message._
-                """,
-                parse_mode=ParseMode.MARKDOWN
-            )
-            success_count += 1
-            # Small delay to avoid rate limiting
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logging.error(f"Error sending broadcast to {user_id}: {e}")
-            fail_count += 1
-    
-    # Send report
-    await update.message.reply_text(
-        f"""
-✅ *Broadcast Completed!*
-
-*Message:* {message}
-*Total Users:* {len(all_users)}
-*Successful:* {success_count}
-*Failed:* {fail_count}
-*Completion Time:* {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-*Note:* Failed messages may be due to users blocking the bot.
         """,
-        parse_mode=ParseMode.MARKDOWN
+        all_users, update.effective_user.id, progress_message.chat_id, progress_message.message_id
     )
-    
-    # Save database backup
-    await save_database_backup(context)
+    broadcast_job.start(context.bot)
 
 # ==================== EXISTING ADMIN COMMANDS (UPDATED) ====================
 async def update_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1220,7 +1997,7 @@ async def receive_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db.set_admin_setting('qr_image', file_id)
         
         # Save to database chat
-        await save_to_database_chat(context, f"""
+        save_to_database_chat(context, f"""
 🏦 PAYMENT QR UPDATED
 ━━━━━━━━━━━━━━━━━━━━━━
 🆔 File ID: `{file_id}`
@@ -1264,7 +2041,7 @@ async def set_paytm_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Save to database chat (without exposing full key)
     masked_key = merchant_key[:10] + "..." if len(merchant_key) > 10 else "***"
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 🏦 PAYTM DETAILS UPDATED
 ━━━━━━━━━━━━━━━━━━━━━━
 🆔 Merchant ID: `{merchant_id}`
@@ -1300,8 +2077,7 @@ async def add_twitter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username, password, email = context.args
     
     # Check if username already exists
-    existing_accounts = [acc for acc in db.data['twitter_stock'] if acc['username'] == username]
-    if existing_accounts:
+    if db.twitter_account_exists(username):
         await update.message.reply_text("❌ This Twitter username already exists in stock.")
         return
     
@@ -1309,7 +2085,7 @@ async def add_twitter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     account_id = db.add_twitter_account(username, password, email, update.effective_user.id)
     
     # Save Twitter details to database chat
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 🐦 TWITTER ACCOUNT ADDED
 ━━━━━━━━━━━━━━━━━━━━━━
 🆔 Account ID: {account_id}
@@ -1366,6 +2142,7 @@ async def transfer_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Add funds
     db.update_balance(user_id, amount)
+    user = db.get_user(user_id)
     
     # Create transaction record
     transaction_id = f"ADMIN_{user_id}_{int(datetime.now().timestamp())}"
@@ -1379,10 +2156,10 @@ async def transfer_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'created_at': str(datetime.now()),
         'completed_at': str(datetime.now())
     }
-    db.data['transactions'].append(transaction)
+    db.add_transaction(transaction)
     
     # Save to database chat
-    await save_to_database_chat(context, f"""
+    save_to_database_chat(context, f"""
 💰 ADMIN FUND TRANSFER
 ━━━━━━━━━━━━━━━━━━━━━━
 👤 To User: {user_id}
@@ -1418,7 +2195,8 @@ async def transfer_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Thank you for using our service!
         """,
-        parse_mode=ParseMode.MARKDOWN
+        parse_mode=ParseMode.MARKDOWN,
+        rate_limit_args=LANE_ADMIN
     )
     
     # Save database backup
@@ -1449,7 +2227,7 @@ async def verify_payment_command(update: Update, context: ContextTypes.DEFAULT_T
     
     if success:
         # Save to database chat
-        await save_to_database_chat(context, f"""
+        save_to_database_chat(context, f"""
 ✅ PAYMENT VERIFIED
 ━━━━━━━━━━━━━━━━━━━━━━
 📋 Payment ID: `{payment_id}`
@@ -1490,6 +2268,8 @@ async def view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admins = db.get_all_admins()
     admin_text = "\n".join([f"• {admin_id}" for admin_id in admins])
     
+    queue_text = ", ".join(f"{lane} {depth}" for lane, depth in outbound.queue_depths().items())
+    
     stats_message = f"""
 📊 *Bot Statistics*
 
@@ -1510,6 +2290,9 @@ async def view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
 *Recent Transactions:*
 {trans_text}
 
+*Outbound Queue:* {queue_text}
+*Render Cache:* {render_cache.hits} hits, {render_cache.misses} renders
+
 *PayTM Status:* {'✅ Configured' if db.get_admin_setting('merchant_id') else '❌ Not Configured'}
     """
     
@@ -1518,6 +2301,66 @@ async def view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=ParseMode.MARKDOWN
     )
 
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /report command"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Unauthorized access.")
+        return
+    
+    if len(context.args) != 2:
+        await update.message.reply_text(
+            "Usage: /report <from> <to>\n"
+            "Example: /report 2024-01-01 2024-01-31 (daily)\n"
+            "Example: /report 2024-01-01T00:00 2024-01-01T23:00 (hourly)"
+        )
+        return
+    
+    try:
+        start = datetime.fromisoformat(context.args[0])
+        end = datetime.fromisoformat(context.args[1])
+    except ValueError:
+        await update.message.reply_text("❌ Invalid date. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM.")
+        return
+    
+    # Plain dates report per day and include the whole last day; times report per hour
+    if len(context.args[0]) == 10 and len(context.args[1]) == 10:
+        period = 'daily'
+        end += timedelta(days=1) - timedelta(microseconds=1)
+    else:
+        period = 'hourly'
+    if end < start:
+        await update.message.reply_text("❌ <from> must be before <to>.")
+        return
+    
+    report = db.get_report(period, start, end)
+    
+    label = 10 if period == 'daily' else 16
+    bucket_lines = [
+        f"• {bucket['start'][:label]}: {bucket['purchases']} sold, ₹{bucket['revenue']:.2f}, "
+        f"deposits ₹{bucket['deposits']:.2f}, {bucket['buyers']} buyers"
+        for bucket in report['buckets'][-REPORT_MAX_BUCKETS:]
+    ]
+    if len(report['buckets']) > REPORT_MAX_BUCKETS:
+        bucket_lines.insert(0, f"… {len(report['buckets']) - REPORT_MAX_BUCKETS} earlier buckets not shown")
+    bucket_text = "\n".join(bucket_lines) if bucket_lines else "No sales in this range"
+    
+    report_message = f"""
+📈 *Sales Report ({period})*
+{start:%Y-%m-%d %H:%M} → {end:%Y-%m-%d %H:%M}
+
+*Accounts Sold:* {report['purchases']}
+*Revenue:* ₹{report['revenue']:.2f}
+*Deposits:* ₹{report['deposits']:.2f}
+*Unique Buyers:* {report['buyers']}
+
+{bucket_text}
+    """
+    
+    await update.message.reply_text(
+        report_message,
+        parse_mode=ParseMode.MARKDOWN
+    )
+
 async def backup_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /backup command"""
     if not db.is_admin(update.effective_user.id):
@@ -1525,7 +2368,7 @@ async def backup_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     await update.message.reply_text("💾 Saving database backup...")
-    success = await save_database_backup(context)
+    success = await save_database_backup(context, force=True)
     
     if success:
         await update.message.reply_text("✅ Database backup saved successfully!")
@@ -1535,10 +2378,84 @@ async def backup_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ==================== MAIN FUNCTION ====================
 async def post_init(application: Application):
     """Initialize database after bot is created"""
-    global db
+    global db, backup_scheduler, housekeeping_task, broadcast_job
     db = ChatDatabase(application.bot)
     # Try to load existing data from chat
     await db.load_from_chat()
+    callback_cache.load(CALLBACK_CACHE_PATH)
+    
+    backup_scheduler = BackupScheduler(db)
+    backup_scheduler.start()
+    housekeeping_task = asyncio.create_task(housekeeping())
+    audit_log.start(application.bot)
+    
+    # Pick up a broadcast the last run did not finish
+    broadcast_job = BroadcastJob.resume()
+    if broadcast_job:
+        logging.info(f"Resuming broadcast {broadcast_job.state['broadcast_id']} at {broadcast_job.state['position']}")
+        broadcast_job.start(application.bot)
+
+async def post_stop(application: Application):
+    """Flush pending changes while the bot can still send"""
+    if housekeeping_task:
+        housekeeping_task.cancel()
+    if broadcast_job:
+        await broadcast_job.stop()
+    await audit_log.stop()
+    callback_cache.save(CALLBACK_CACHE_PATH)
+    if backup_scheduler:
+        await backup_scheduler.stop()
+    if db:
+        db.close()
+
+# ==================== WEB SERVER ====================
+async def telegram_webhook(request):
+    """Hand an update Telegram posted to the application's queue"""
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    application = request.app['application']
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        logging.error(f"Error decoding webhook update: {e}")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+async def serve(application: Application):
+    """Run the bot and the aiohttp app (health check, webhook) on one event loop"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    app['application'] = application
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    
+    async with application:
+        await post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET
+            )
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await web.TCPSite(runner, "0.0.0.0", PORT).start()
+        print(f"🌐 Listening on port {PORT} ({'webhook ' + WEBHOOK_URL if WEBHOOK_URL else 'long polling'})")
+        try:
+            await stop.wait()
+        finally:
+            # Stop taking updates before handlers lose the database
+            await runner.cleanup()
+            if application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            await post_stop(application)
 
 def main():
     """Start the bot"""
@@ -1549,7 +2466,13 @@ def main():
     )
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .rate_limiter(outbound)
+        .build()
+    )
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -1559,6 +2482,7 @@ def main():
     application.add_handler(CommandHandler("tfund", transfer_funds))
     application.add_handler(CommandHandler("verify", verify_payment_command))
     application.add_handler(CommandHandler("statics", view_statistics))
+    application.add_handler(CommandHandler("report", report_command))
     application.add_handler(CommandHandler("backup", backup_database))
     
     # Add new admin feature handlers
@@ -1576,19 +2500,31 @@ def main():
     )
     application.add_handler(qr_conv_handler)
     
+    # Check Payment waits for that user's next text as the UTR; menu buttons still work meanwhile
+    utr_conv_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(handle_callback, pattern=is_check_payment)],
+        states={
+            WAITING_FOR_PAYMENT_VERIFICATION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Text(list(BUTTON_ROUTES)), handle_utr)
+            ]
+        },
+        fallbacks=[],
+        allow_reentry=True
+    )
+    application.add_handler(utr_conv_handler)
+    
     # Add callback query handler
     application.add_handler(CallbackQueryHandler(handle_callback))
     
     # Add message handlers
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^\d+$'), handle_utr))
     
     # Start the bot
     print("🤖 Bot is starting...")
     print(f"📊 Database Chat ID: {DATABASE_CHAT_ID}")
     print(f"👑 Admin Chat ID: {ADMIN_CHAT_ID}")
     print(f"🔑 Default Admin ID: {ADMIN_CHAT_ID}")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    asyncio.run(serve(application))
 
 if __name__ == '__main__':
     main()
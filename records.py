@@ -0,0 +1,136 @@
+"""Compact record types for the in-memory storage backends
+
+Records keep timestamps as integer microseconds since the epoch and money
+as integer paise. to_dict/from_dict convert to and from the JSON layout
+used by snapshots, logs, chat backups and the bot's handlers.
+"""
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+from typing import Optional
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+def to_micros(value) -> Optional[int]:
+    """'2024-01-01 12:00:00.123456' (str(datetime)) or a datetime -> epoch microseconds"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return (value - EPOCH) // MICROSECOND
+
+def from_micros(value: Optional[int]) -> Optional[str]:
+    """Epoch microseconds -> the str(datetime) form stored in the JSON layout"""
+    if value is None:
+        return None
+    return str(EPOCH + value * MICROSECOND)
+
+def now_micros() -> int:
+    return to_micros(datetime.now())
+
+def to_paise(amount) -> Optional[int]:
+    if amount is None:
+        return None
+    return round(amount * 100)
+
+def from_paise(paise: Optional[int]) -> Optional[float]:
+    if paise is None:
+        return None
+    return paise / 100
+
+class Record:
+    """Field conversion shared by the record types below"""
+    __slots__ = ()
+    TIME_FIELDS = ()
+    MONEY_FIELDS = ()
+
+    def to_dict(self) -> dict:
+        """Return the record in its JSON layout"""
+        data = {}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if field.name in self.TIME_FIELDS:
+                value = from_micros(value)
+            elif field.name in self.MONEY_FIELDS:
+                value = from_paise(value)
+            data[field.name] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Build a record from its JSON layout"""
+        values = {}
+        for field in fields(cls):
+            value = data.get(field.name)
+            if field.name in cls.TIME_FIELDS:
+                value = to_micros(value)
+            elif field.name in cls.MONEY_FIELDS:
+                value = to_paise(value)
+            values[field.name] = value
+        return cls(**values)
+
+@dataclass(slots=True)
+class User(Record):
+    TIME_FIELDS = ('join_date', 'last_active')
+    MONEY_FIELDS = ('balance', 'total_spent')
+
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    balance: int = 0
+    total_spent: int = 0
+    total_purchases: int = 0
+    join_date: int = 0
+    last_active: int = 0
+
+@dataclass(slots=True)
+class StockAccount(Record):
+    TIME_FIELDS = ('added_date', 'sold_date')
+
+    id: int
+    username: str
+    password: str
+    email: str
+    added_by: Optional[int]
+    added_date: int = 0
+    sold_to: Optional[int] = None
+    sold_date: Optional[int] = None
+    is_sold: bool = False
+
+@dataclass(slots=True)
+class Payment(Record):
+    TIME_FIELDS = ('created_at', 'verified_at')
+    MONEY_FIELDS = ('amount',)
+
+    payment_id: str
+    user_id: int
+    amount: Optional[int] = None
+    utr: Optional[str] = None
+    status: str = 'pending'
+    qr_sent: bool = True
+    created_at: int = 0
+    verified_at: Optional[int] = None
+    verified_by: Optional[int] = None
+
+@dataclass(slots=True)
+class Transaction(Record):
+    TIME_FIELDS = ('created_at', 'completed_at')
+    MONEY_FIELDS = ('amount',)
+
+    transaction_id: str
+    user_id: int
+    amount: int
+    type: str
+    status: str
+    details: str
+    created_at: int = 0
+    completed_at: Optional[int] = None
+
+# JSON collection name -> record type
+RECORD_TYPES = {
+    'users': User,
+    'twitter_stock': StockAccount,
+    'payments': Payment,
+    'transactions': Transaction
+}
@@ -0,0 +1,108 @@
+"""Hourly and daily sales rollups, kept up to date as transactions are recorded
+
+Each bucket holds the number of purchases, revenue and deposits (paise)
+and how many purchases each buyer made, so unique buyers can be counted
+over any range of buckets without reading raw transactions.
+"""
+import bisect
+from datetime import datetime
+from typing import Dict, Optional
+
+from records import from_micros, from_paise, to_micros
+
+PERIODS = {
+    'hourly': 3600 * 1000000,  # bucket width in microseconds
+    'daily': 86400 * 1000000
+}
+
+def contribution(transaction_type: str, amount: int):
+    """(purchases, revenue, deposits) a transaction adds to its buckets, or None"""
+    if transaction_type == 'purchase_twitter':
+        return 1, amount, 0
+    if transaction_type == 'add_funds':
+        return 0, 0, amount
+    return None
+
+def bucket_of(period: str, created_at: int) -> int:
+    return created_at // PERIODS[period]
+
+def bucket_start(period: str, bucket: int) -> str:
+    return from_micros(bucket * PERIODS[period])
+
+def report_totals(period: str, rows, buyers: int) -> Dict:
+    """Shape (bucket, purchases, revenue, deposits, buyers) rows into a report"""
+    buckets = [
+        {
+            'start': bucket_start(period, bucket),
+            'purchases': purchases,
+            'revenue': from_paise(revenue),
+            'deposits': from_paise(deposits),
+            'buyers': bucket_buyers
+        }
+        for bucket, purchases, revenue, deposits, bucket_buyers in rows
+    ]
+    return {
+        'period': period,
+        'buckets': buckets,
+        'purchases': sum(b['purchases'] for b in buckets),
+        'revenue': from_paise(sum(row[2] for row in rows)),
+        'deposits': from_paise(sum(row[3] for row in rows)),
+        'buyers': buyers
+    }
+
+class Rollups:
+    """Time-ordered rollup buckets for the in-memory backends"""
+    def __init__(self):
+        # period -> (sorted bucket numbers, bucket -> [purchases, revenue, deposits, {user_id: purchases}])
+        self.series = {period: ([], {}) for period in PERIODS}
+
+    def add(self, transaction, sign: int = 1):
+        """Count a Transaction record in its buckets; sign=-1 takes it back out"""
+        amounts = contribution(transaction.type, transaction.amount)
+        if amounts is None:
+            return
+        purchases, revenue, deposits = amounts
+        for period, (keys, buckets) in self.series.items():
+            bucket = bucket_of(period, transaction.created_at)
+            stats = buckets.get(bucket)
+            if stats is None:
+                stats = buckets[bucket] = [0, 0, 0, {}]
+                bisect.insort(keys, bucket)  # appends in the usual in-order case
+            stats[0] += sign * purchases
+            stats[1] += sign * revenue
+            stats[2] += sign * deposits
+            if purchases:
+                buyers = stats[3]
+                buyers[transaction.user_id] = buyers.get(transaction.user_id, 0) + sign
+                if buyers[transaction.user_id] <= 0:
+                    del buyers[transaction.user_id]
+
+    def report(self, period: str, start: datetime, end: datetime):
+        """Totals for the buckets from start through end, found by bisection"""
+        keys, buckets = self.series[period]
+        lo = bisect.bisect_left(keys, bucket_of(period, to_micros(start)))
+        hi = bisect.bisect_right(keys, bucket_of(period, to_micros(end)))
+        rows, buyers = [], set()
+        for bucket in keys[lo:hi]:
+            purchases, revenue, deposits, bucket_buyers = buckets[bucket]
+            rows.append((bucket, purchases, revenue, deposits, len(bucket_buyers)))
+            buyers.update(bucket_buyers)
+        return report_totals(period, rows, len(buyers))
+
+    def export_state(self):
+        """JSON layout: period -> [[bucket, purchases, revenue, deposits, [[user_id, purchases], ...]], ...]"""
+        return {
+            period: [[bucket] + buckets[bucket][:3] + [list(buckets[bucket][3].items())] for bucket in keys]
+            for period, (keys, buckets) in self.series.items()
+        }
+
+    @classmethod
+    def from_state(cls, state: Optional[dict]):
+        rollups = cls()
+        for period, rows in (state or {}).items():
+            keys, buckets = rollups.series[period]
+            for bucket, purchases, revenue, deposits, buyers in rows:
+                keys.append(bucket)
+                buckets[bucket] = [purchases, revenue, deposits, dict(buyers)]
+            keys.sort()
+        return rollups
@@ -0,0 +1,2068 @@
+"""Storage backends for the bot's users, stock, payments and transactions"""
+import os
+import gzip
+import json
+import logging
+import sqlite3
+import threading
+import hashlib
+import bisect
+import heapq
+import mmap
+import time
+from collections import deque
+from contextlib import closing
+from itertools import count, islice
+from typing import Callable, Dict, List, Optional, Protocol
+from datetime import datetime
+
+from rollups import PERIODS, Rollups, bucket_of, contribution, report_totals
+from records import RECORD_TYPES, Payment, Record, StockAccount, Transaction, User, from_paise, now_micros, to_micros, to_paise
+
+TWITTER_PRICE = 5 # default price per account when none is configured
+RECENT_TRANSACTIONS = 5  # per-user ring buffer size, enough for the balance screen
+STATS_RECENT = 10  # transactions listed by /statics
+RESERVATION_TTL = 600  # seconds a checkout may hold stock and funds before they are released
+
+# Collections whose changed records are shipped in delta snapshots
+DELTA_COLLECTIONS = ('users', 'twitter_stock', 'payments', 'transactions', 'used_twitter_accounts')
+
+# ==================== WRITE-AHEAD LOG ====================
+class WriteAheadLog:
+    """Append-only JSON lines log of database mutations"""
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self.count = 0  # records appended since last compaction
+        self._file = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    
+    def append(self, record: dict):
+        """Write one record; cost depends only on the record size"""
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.count += 1
+    
+    def rotated_files(self):
+        """Logs set aside by rotate, oldest first, as (last seq, path)"""
+        directory, name = os.path.split(self.path)
+        root, ext = os.path.splitext(name)
+        rotated = []
+        for other in os.listdir(directory or "."):
+            seq = other[len(root) + 1:-len(ext)]
+            if other.startswith(root + ".") and other.endswith(ext) and seq.isdigit():
+                rotated.append((int(seq), os.path.join(directory, other)))
+        return sorted(rotated)
+    
+    def replay(self):
+        """Yield logged records in order, stopping at a torn final line of each file"""
+        for path in [path for _, path in self.rotated_files()] + [self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Ignoring incomplete WAL record in {path}")
+                        break
+                    yield record
+    
+    def rotate(self, seq: int):
+        """Set the records up to seq aside so later appends start a fresh log"""
+        self.close()
+        if os.path.exists(self.path):
+            root, ext = os.path.splitext(self.path)
+            os.replace(self.path, f"{root}.{seq:020d}{ext}")
+        self.count = 0
+    
+    def drop_rotated(self, seq: int):
+        """Delete logs set aside up to seq once a snapshot covers them"""
+        for last_seq, path in self.rotated_files():
+            if last_seq <= seq:
+                os.remove(path)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# ==================== SNAPSHOT FILES ====================
+SNAPSHOT_MAGIC = b"KXSNAP"
+SNAPSHOT_HEADER_SIZE = 100  # fixed width so it can be rewritten after the body
+
+def fsync_directory(path: str):
+    """Make a rename in path durable"""
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file_atomic(path: str, data):
+    """Write data to path via temp file, fsync and rename"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(path))
+
+def write_snapshot_file(path: str, seq: int, rows):
+    """Atomically write rows as JSON lines behind a header holding seq and a sha256 of the body"""
+    digest = hashlib.sha256()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b" " * (SNAPSHOT_HEADER_SIZE - 1) + b"\n")
+        for row in rows:
+            line = json.dumps(row, default=str).encode() + b"\n"
+            digest.update(line)
+            f.write(line)
+        header = b"%s 1 %d %s" % (SNAPSHOT_MAGIC, seq, digest.hexdigest().encode())
+        f.seek(0)
+        f.write(header.ljust(SNAPSHOT_HEADER_SIZE - 1) + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(path))
+
+def read_snapshot_file(path: str, load_row):
+    """Verify a snapshot file and feed each row to load_row; returns its seq
+
+    The file is memory-mapped, so rows are parsed one line at a time
+    without reading the whole body into a separate buffer first.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header = mm.readline().split()
+        if len(header) != 4 or header[0] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+        seq, expected = int(header[2]), header[3].decode()
+        body = memoryview(mm)[SNAPSHOT_HEADER_SIZE:]
+        try:
+            actual = hashlib.sha256(body).hexdigest()
+        finally:
+            body.release()
+        if actual != expected:
+            raise ValueError(f"Checksum mismatch in {path}")
+        for line in iter(mm.readline, b""):
+            load_row(*json.loads(line))
+    return seq
+
+def statistics_match(running: dict, recomputed: dict):
+    """Compare get_statistics results, allowing float noise below a paisa in money totals"""
+    money = ('total_balance', 'total_sales')
+    return (
+        all(abs(running[key] - recomputed[key]) < 0.005 for key in money)
+        and all(running[key] == recomputed[key] for key in running if key not in money)
+    )
+
+# ==================== COLD SEGMENTS ====================
+def thaw_archive(loaded_data: dict, blobs: Dict[str, bytes]) -> dict:
+    """A snapshot with its cold segment rows moved back in, for backends that keep no segments"""
+    archive = loaded_data.get('archive') or {}
+    if not archive.get('segments'):
+        return loaded_data
+    missing = [name for name in archive['segments'] if name not in blobs]
+    if missing:
+        # Positions cannot line up without every segment; keep the totals, lose the old rows
+        logging.error(f"Cold segments {missing} were not provided; archived records are not restored")
+        data = dict(loaded_data)
+        data['archive'] = {'tx_base': archive.get('tx_base', 0), 'archived_sales': archive.get('archived_sales', 0)}
+        return data
+    transactions, payments = [], {}
+    for name in archive['segments']:
+        rows = gzip.decompress(blobs[name]).decode("utf-8").splitlines()[1:]  # after the header
+        for collection, key, value in map(json.loads, rows):
+            if collection == 'transactions':
+                transactions.append((key, value))
+            elif collection == 'payments':
+                payments[key] = value
+    if len(transactions) != archive.get('tx_base', 0):
+        logging.warning(f"Cold segments hold {len(transactions)} transactions, expected {archive.get('tx_base', 0)}")
+    transactions.sort(key=lambda row: row[0])  # by position
+    hot_payments = loaded_data.get('payments', [])
+    hot_ids = {p['payment_id'] for p in hot_payments}
+    data = dict(loaded_data)
+    data['transactions'] = [value for _, value in transactions] + list(loaded_data.get('transactions', []))
+    data['payments'] = [p for payment_id, p in payments.items() if payment_id not in hot_ids] + list(hot_payments)
+    data['archive'] = {}
+    return data
+
+# ==================== RESERVATIONS ====================
+class Reservations:
+    """Stock and funds held by checkouts between reserve and commit
+
+    Holds live in memory only. Nothing is charged or sold until commit, so
+    a restart simply releases them.
+    """
+    def __init__(self):
+        self.open = {}  # reservation_id -> reservation
+        self.by_user = {}  # user_id -> ids of their open reservations
+        self.held_count = 0  # accounts held across all reservations
+        self.expiry = []  # min-heap of (expires_at, reservation_id)
+        self.pinned = set()  # ids that stay open until committed, e.g. while being delivered
+        self.ids = count(1)
+    
+    def held(self, user_id: int):
+        """Funds held for user_id, in the backend's money unit"""
+        return sum(self.open[reservation_id]['amount'] for reservation_id in self.by_user.get(user_id, ()))
+    
+    def add(self, user_id: int, price: float, amount, account_ids: list, ttl: float) -> dict:
+        reservation = {
+            'reservation_id': f"RES_{user_id}_{next(self.ids)}",
+            'user_id': user_id,
+            'price': price,  # per account, as configured
+            'amount': amount,
+            'account_ids': account_ids,
+            'expires_at': time.monotonic() + ttl
+        }
+        reservation_id = reservation['reservation_id']
+        self.open[reservation_id] = reservation
+        self.by_user.setdefault(user_id, set()).add(reservation_id)
+        self.held_count += len(account_ids)
+        heapq.heappush(self.expiry, (reservation['expires_at'], reservation_id))
+        return reservation
+    
+    def pop(self, reservation_id: str) -> Optional[dict]:
+        """Remove and return an open reservation, or None if it was settled or expired"""
+        reservation = self.open.pop(reservation_id, None)
+        if reservation is not None:
+            user_reservations = self.by_user[reservation['user_id']]
+            user_reservations.discard(reservation_id)
+            if not user_reservations:
+                del self.by_user[reservation['user_id']]
+            self.held_count -= len(reservation['account_ids'])
+            self.pinned.discard(reservation_id)
+        return reservation
+    
+    def pin(self, reservation_id: str) -> bool:
+        """Stop an open reservation from expiring; False if it already settled or expired"""
+        if reservation_id not in self.open:
+            return False
+        self.pinned.add(reservation_id)
+        return True
+    
+    def expired(self) -> List[str]:
+        """Ids of open reservations past their expiry"""
+        now = time.monotonic()
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            reservation_id = heapq.heappop(self.expiry)[1]
+            if reservation_id in self.open and reservation_id not in self.pinned:
+                expired.append(reservation_id)
+        return expired
+
+# ==================== STORAGE PROTOCOL ====================
+class Storage(Protocol):
+    """Everything the bot reads or writes goes through these methods"""
+    seq: int  # number of mutations applied so far
+    catalog_version: int  # bumped whenever available stock, the price or a setting changes
+    has_local_state: bool  # True when data was restored from local files
+    on_change: Optional[Callable[[], None]]  # called after every mutation
+    
+    # persistence
+    def export_data(self) -> dict: ...
+    def export_job(self) -> Callable[[], dict]: ...
+    def import_data(self, loaded_data: dict): ...
+    def compact(self): ...
+    def compaction_job(self, min_records: int = 0) -> Optional[Callable[[], None]]: ...
+    def close(self): ...
+    def export_delta(self) -> dict: ...
+    def apply_delta(self, delta: dict): ...
+    def clear_dirty(self): ...
+    
+    # archival
+    def archive(self, older_than: datetime, verified_before: datetime) -> int: ...
+    def plan_archive(self, older_than: datetime, verified_before: datetime) -> Optional[dict]: ...
+    def write_archive(self, plan: dict): ...
+    def finish_archive(self, plan: dict) -> int: ...
+    def read_segment(self, name: str) -> bytes: ...
+    def write_segment(self, name: str, blob: bytes): ...
+    
+    # users & admins
+    def get_user(self, user_id: int) -> Optional[dict]: ...
+    def create_user(self, user_id: int, username: str, first_name: str, last_name: str) -> bool: ...
+    def get_all_users(self) -> List[int]: ...
+    def update_balance(self, user_id: int, amount: float, add: bool = True) -> bool: ...
+    def is_admin(self, user_id: int) -> bool: ...
+    def add_admin(self, user_id: int, added_by: int) -> bool: ...
+    def remove_admin(self, user_id: int) -> bool: ...
+    def get_all_admins(self) -> List[int]: ...
+    
+    # settings
+    def get_admin_setting(self, key: str): ...
+    def set_admin_setting(self, key: str, value) -> bool: ...
+    def get_twitter_price(self) -> float: ...
+    def update_twitter_price(self, new_price: float) -> bool: ...
+    
+    # stock
+    def add_twitter_account(self, username: str, password: str, email: str, added_by: int) -> int: ...
+    def twitter_account_exists(self, username: str) -> bool: ...
+    def get_available_twitter_count(self) -> int: ...
+    def get_twitter_accounts(self, limit: int = 20) -> List[dict]: ...
+    def purchase_twitter_account(self, user_id: int, quantity: int) -> Optional[List[dict]]: ...
+    def reserve_twitter_accounts(self, user_id: int, quantity: int, ttl: float = RESERVATION_TTL) -> Optional[dict]: ...
+    def commit_reservation(self, reservation_id: str, quantity: int = None) -> Optional[List[dict]]: ...
+    def pin_reservation(self, reservation_id: str) -> bool: ...
+    def release_reservation(self, reservation_id: str) -> bool: ...
+    def expire_reservations(self) -> int: ...
+    
+    # payments & transactions
+    def create_payment(self, payment_id: str, user_id: int) -> dict: ...
+    def update_payment_utr(self, payment_id: str, utr: str) -> bool: ...
+    def verify_payment(self, payment_id: str, amount: float, verified_by: int) -> bool: ...
+    def get_payment(self, payment_id: str) -> Optional[dict]: ...
+    def get_payment_by_utr(self, utr: str) -> Optional[dict]: ...
+    def add_transaction(self, transaction: dict) -> bool: ...
+    def get_user_transactions(self, user_id: int, limit: int = 5) -> List[dict]: ...
+    def get_statistics(self) -> Dict: ...
+    def get_report(self, period: str, start: datetime, end: datetime) -> Dict: ...
+
+# Public names a wrapper may forward to a Storage implementation
+STORAGE_API = frozenset(
+    [name for name in vars(Storage) if not name.startswith('_')] + list(Storage.__annotations__)
+)
+
+# ==================== IN-MEMORY STORAGE ====================
+class MemoryStorage:
+    """Keeps everything in one dict of compact records; nothing survives a restart"""
+    def __init__(self, default_admin: int = None, default_price: float = TWITTER_PRICE,
+                 check_statistics: bool = False):
+        self.default_admin = default_admin
+        self.default_price = default_price
+        self.check_statistics = check_statistics  # compare running totals with a full recompute
+        self.data = {
+            'users': {},  # str(user_id) -> User
+            'twitter_stock': [],  # StockAccount, id = position + 1
+            'transactions': [],  # Transaction
+            'payments': {},  # payment_id -> Payment, in creation order
+            'admin_settings': {},
+            'used_twitter_accounts': set(),
+            'admins': [default_admin] if default_admin is not None else []  # Default admin list
+        }
+        self.seq = 0
+        self.catalog_version = 0  # lets screens that show stock and price be cached
+        self.has_local_state = False
+        self.on_change = None
+        self.archive_dir = None  # set by backends that can keep cold segments on disk
+        self.thawing = {}  # segment name -> blob, folded into the next import when there is no archive_dir
+        self.reset_archive()
+        self.rebuild_free_list()
+        self.rebuild_utr_index()
+        self.rebuild_transaction_index()
+        self.rebuild_statistics()
+        self.rebuild_rollups()
+        self.clear_dirty()
+    
+    def _record(self, op: str, changes: list):
+        """Hook called with the (collection, key, value) changes of every mutation"""
+        # Changes leave as the JSON layout; records stay compact in memory
+        changes = [
+            [collection, key, value.to_dict() if isinstance(value, Record) else value]
+            for collection, key, value in changes
+        ]
+        self._log(op, changes)
+        for collection, key, value in changes:
+            if collection in self.dirty:
+                self.dirty[collection][key] = value
+        self.seq += 1
+        if self.on_change:
+            self.on_change()
+    
+    def _log(self, op: str, changes: list):
+        """Persist a mutation before it counts; nothing to do in memory"""
+    
+    def _apply_change(self, collection: str, key, value):
+        """Apply one logged or delta change to self.data"""
+        if collection in RECORD_TYPES:
+            value = RECORD_TYPES[collection].from_dict(value)
+        if collection == 'users':
+            old = self.data['users'].get(key)
+            self.total_balance += value.balance - (old.balance if old else 0)
+            self.data['users'][key] = value
+        elif collection == 'twitter_stock':
+            # Stock ids are sequential, so the id doubles as list position
+            if key <= len(self.data['twitter_stock']):
+                was_unsold = not self.data['twitter_stock'][key - 1].is_sold
+                self.data['twitter_stock'][key - 1] = value
+            else:
+                was_unsold = False
+                self.data['twitter_stock'].append(value)
+            if was_unsold and value.is_sold:
+                self.available_count -= 1  # its free-list entry is skipped once reached
+                self.catalog_version += 1
+            elif not was_unsold and not value.is_sold:
+                self.available_count += 1
+                self.free_list.append(key)
+                self.catalog_version += 1
+        elif collection == 'payments':
+            self._unindex_utr(self.data['payments'].get(key))
+            self.data['payments'][key] = value
+            self._index_utr(value)
+        elif collection == 'transactions':
+            # Keyed by absolute position, counting archived ones; older log records carry no key
+            if key is not None and 0 <= key - self.tx_base < len(self.data['transactions']):
+                old = self.data['transactions'][key - self.tx_base]
+                self.data['transactions'][key - self.tx_base] = value
+                self.rollups.add(old, -1)
+                self.rollups.add(value)
+                for user_id in {old.user_id, value.user_id}:
+                    self._reindex_user(user_id)
+                self.rebuild_statistics()
+            else:
+                self._append_transaction(value)
+        elif collection == 'admin_settings':
+            self.data['admin_settings'][key] = value
+            self.catalog_version += 1
+        elif collection == 'admins':
+            self.data['admins'] = value
+        elif collection == 'used_twitter_accounts':
+            self.data['used_twitter_accounts'].add(key)
+        elif collection == 'archive':
+            self._drop_archived(key, value)
+        elif collection == 'archive_state':
+            self._load_archive_state(value)
+        elif collection == 'rollups':
+            self.rollups = Rollups.from_state(value)
+    
+    def clear_dirty(self):
+        """Forget changed records, e.g. once a full snapshot covers them"""
+        self.dirty = {collection: {} for collection in DELTA_COLLECTIONS}
+    
+    def export_delta(self):
+        """Return the records changed since the last export and start tracking afresh"""
+        dirty = self.dirty
+        self.clear_dirty()
+        return {
+            'users': dirty['users'],
+            'twitter_stock': list(dirty['twitter_stock'].values()),
+            'payments': list(dirty['payments'].values()),
+            'transactions': [[position, t] for position, t in dirty['transactions'].items()],
+            'used_twitter_accounts': list(dirty['used_twitter_accounts']),
+            'admin_settings': self.data['admin_settings'],
+            'admins': self.data['admins']
+        }
+    
+    def apply_delta(self, delta: dict):
+        """Apply a delta produced by export_delta on top of the current data"""
+        for key, user in delta['users'].items():
+            self._apply_change('users', key, user)
+        for account in delta['twitter_stock']:
+            self._apply_change('twitter_stock', account['id'], account)
+        for payment in delta['payments']:
+            self._apply_change('payments', payment['payment_id'], payment)
+        for position, transaction in sorted(delta['transactions'], key=lambda x: x[0]):
+            self._apply_change('transactions', position, transaction)
+        self.data['used_twitter_accounts'].update(delta['used_twitter_accounts'])
+        self.data['admin_settings'] = delta['admin_settings']
+        self.data['admins'] = delta['admins']
+        self.catalog_version += 1
+    
+    def rebuild_utr_index(self):
+        """Recompute the UTR -> payment_id index of in-memory payments after a bulk load"""
+        self.utr_index = {}
+        for payment in self.data['payments'].values():
+            self._index_utr(payment)
+    
+    def _index_utr(self, payment):
+        if payment is not None and payment.utr:
+            self.utr_index[payment.utr] = payment.payment_id
+    
+    def _unindex_utr(self, payment):
+        if payment is not None and payment.utr and self.utr_index.get(payment.utr) == payment.payment_id:
+            del self.utr_index[payment.utr]
+    
+    def rebuild_rollups(self):
+        """Recompute rollups from in-memory transactions, for data saved before rollups existed"""
+        self.rollups = Rollups()
+        for transaction in self.data['transactions']:
+            self.rollups.add(transaction)
+    
+    def rebuild_statistics(self):
+        """Recompute the running totals behind get_statistics after a bulk load"""
+        self.total_balance = sum(user.balance for user in self.data['users'].values())  # paise
+        self.total_sales = self.archived_sales + sum(
+            t.amount for t in self.data['transactions'] if t.type == 'purchase_twitter'
+        )
+        # Min-heap of the newest transactions as (created_at, -position, transaction); ties favour older positions
+        self.recent_heap = heapq.nlargest(
+            STATS_RECENT,
+            ((t.created_at, -position, t) for position, t in enumerate(self.data['transactions'], self.tx_base))
+        )
+        heapq.heapify(self.recent_heap)
+    
+    def rebuild_transaction_index(self):
+        """Recompute per-user transaction positions and recent buffers after a bulk load"""
+        self.tx_positions = {}  # user_id -> absolute positions of their in-memory transactions
+        self.recent_tx = {}  # user_id -> their newest transactions, hot or cold, oldest first
+        for position, transaction in enumerate(self.data['transactions'], self.tx_base):
+            self.tx_positions.setdefault(transaction.user_id, []).append(position)
+        for user_id, positions in self.tx_positions.items():
+            self._fill_recent(user_id, [self.data['transactions'][p - self.tx_base] for p in positions[-RECENT_TRANSACTIONS:]])
+    
+    def _fill_recent(self, user_id: int, transactions: list):
+        """Set a user's recent buffer, unless older ones may still be missing from it"""
+        if len(transactions) >= RECENT_TRANSACTIONS or not any(user_id in s['user_ids'] for s in self.segments.values()):
+            self.recent_tx[user_id] = sorted(transactions, key=lambda t: t.created_at)[-RECENT_TRANSACTIONS:]
+        else:
+            self.recent_tx.pop(user_id, None)  # filled on the next lookup
+    
+    def _reindex_user(self, user_id: int):
+        positions = [p for p, t in enumerate(self.data['transactions'], self.tx_base) if t.user_id == user_id]
+        self.tx_positions[user_id] = positions
+        self.recent_tx.pop(user_id, None)
+    
+    def _append_transaction(self, transaction):
+        """Append a transaction, index it under its user and return its absolute position"""
+        self.data['transactions'].append(transaction)
+        position = self.tx_base + len(self.data['transactions']) - 1
+        if transaction.type == 'purchase_twitter':
+            self.total_sales += transaction.amount
+        self.rollups.add(transaction)
+        entry = (transaction.created_at, -position, transaction)
+        if len(self.recent_heap) < STATS_RECENT:
+            heapq.heappush(self.recent_heap, entry)
+        elif entry > self.recent_heap[0]:
+            heapq.heapreplace(self.recent_heap, entry)
+        self.tx_positions.setdefault(transaction.user_id, []).append(position)
+        recent = self.recent_tx.get(transaction.user_id)
+        if recent is not None:
+            recent.append(transaction)
+            if len(recent) > RECENT_TRANSACTIONS:
+                del recent[0]
+        elif len(self.tx_positions[transaction.user_id]) == 1:
+            self._fill_recent(transaction.user_id, [transaction])
+        return position
+    
+    def rebuild_free_list(self):
+        """Recompute the unsold stock queue after a bulk load; open reservations are dropped"""
+        self.free_list = deque(acc.id for acc in self.data['twitter_stock'] if not acc.is_sold)  # oldest first
+        self.available_count = len(self.free_list)
+        self.catalog_version += 1
+        self.reservations = Reservations()
+    
+    def _unsold_ids(self):
+        """Yield unsold stock ids oldest first, dropping entries sold since they were queued"""
+        stock = self.data['twitter_stock']
+        while self.free_list and stock[self.free_list[0] - 1].is_sold:
+            self.free_list.popleft()
+        for account_id in self.free_list:
+            if not stock[account_id - 1].is_sold:
+                yield account_id
+    
+    def capture(self):
+        """Copy the containers so a worker thread can serialize them while mutations go on
+
+        Records are shared rather than copied. One changed after the capture is
+        written with its newer values, and the log or the next delta carries that
+        change again, where applying it sets the same values.
+        """
+        return {
+            'archive_state': self.archive_state(),
+            'rollups': self.rollups.export_state(),
+            'users': list(self.data['users'].items()),
+            'twitter_stock': list(self.data['twitter_stock']),
+            'payments': list(self.data['payments'].values()),
+            'transactions': list(self.data['transactions']),
+            'tx_base': self.tx_base,
+            'admin_settings': dict(self.data['admin_settings']),
+            'admins': list(self.data['admins']),
+            'used_twitter_accounts': list(self.data['used_twitter_accounts'])
+        }
+    
+    def iter_rows(self, captured: dict = None):
+        """Yield the whole dataset as (collection, key, value) rows in list order"""
+        captured = captured or self.capture()
+        yield ['archive_state', None, captured['archive_state']]
+        yield ['rollups', None, captured['rollups']]
+        for key, user in captured['users']:
+            yield ['users', key, user.to_dict()]
+        for account in captured['twitter_stock']:
+            yield ['twitter_stock', account.id, account.to_dict()]
+        for payment in captured['payments']:
+            yield ['payments', payment.payment_id, payment.to_dict()]
+        for position, transaction in enumerate(captured['transactions'], captured['tx_base']):
+            yield ['transactions', position, transaction.to_dict()]
+        for key, value in captured['admin_settings'].items():
+            yield ['admin_settings', key, value]
+        yield ['admins', None, captured['admins']]
+        for username in captured['used_twitter_accounts']:
+            yield ['used_twitter_accounts', username, True]
+    
+    def _load_row(self, collection: str, key, value):
+        """Load one row from iter_rows; rows arrive in order so lists just grow"""
+        if collection in ('twitter_stock', 'transactions'):
+            self.data[collection].append(RECORD_TYPES[collection].from_dict(value))
+        else:
+            self._apply_change(collection, key, value)
+    
+    def export_job(self):
+        """Capture the data now; the returned job builds export_data's result, e.g. in a worker thread"""
+        captured = self.capture()
+        
+        def export():
+            return {
+                'users': {key: user.to_dict() for key, user in captured['users']},
+                'twitter_stock': [account.to_dict() for account in captured['twitter_stock']],
+                'transactions': [transaction.to_dict() for transaction in captured['transactions']],
+                'payments': [payment.to_dict() for payment in captured['payments']],
+                'admin_settings': captured['admin_settings'],
+                'used_twitter_accounts': sorted(captured['used_twitter_accounts']),
+                'admins': captured['admins'],
+                'archive': captured['archive_state'],
+                'rollups': captured['rollups']
+            }
+        return export
+    
+    def export_data(self):
+        """Return self.data in its JSON layout"""
+        return self.export_job()()
+    
+    def import_data(self, loaded_data: dict):
+        """Replace self.data with a decoded snapshot"""
+        if self.archive_dir is None:
+            loaded_data = thaw_archive(loaded_data, self.thawing)
+            self.thawing = {}
+        self._load_archive_state(loaded_data.get('archive', {}))
+        for key in loaded_data:
+            if key == 'users':
+                self.data['users'] = {k: User.from_dict(user) for k, user in loaded_data['users'].items()}
+            elif key == 'payments':
+                self.data['payments'] = {p['payment_id']: Payment.from_dict(p) for p in loaded_data['payments']}
+            elif key in RECORD_TYPES:
+                self.data[key] = [RECORD_TYPES[key].from_dict(record) for record in loaded_data[key]]
+            elif key not in ('archive', 'rollups'):
+                self.data[key] = loaded_data[key]
+        
+        # Ensure default admin is always in list
+        if self.default_admin is not None and self.default_admin not in self.data['admins']:
+            self.data['admins'].append(self.default_admin)
+        
+        # Convert used_twitter_accounts back to set
+        if 'used_twitter_accounts' in self.data:
+            self.data['used_twitter_accounts'] = set(self.data['used_twitter_accounts'])
+        self.rebuild_free_list()
+        self.rebuild_utr_index()
+        self.rebuild_transaction_index()
+        self.rebuild_statistics()
+        if 'rollups' in loaded_data:
+            self.rollups = Rollups.from_state(loaded_data['rollups'])
+        else:
+            self.rebuild_rollups()
+    
+    def compaction_job(self, min_records: int = 0):
+        """Nothing to compact in memory"""
+        return None
+    
+    def compact(self):
+        """Compact right away, e.g. once a restore replaced everything"""
+        job = self.compaction_job()
+        if job:
+            job()
+    
+    def close(self):
+        """Nothing to release in memory"""
+    
+    # ---------- archival ----------
+    def reset_archive(self):
+        """Forget all cold segments"""
+        self.tx_base = 0  # absolute position of data['transactions'][0]
+        self.archived_sales = 0  # purchase totals (paise) that moved to cold segments
+        self.segments = {}  # segment name -> ids it holds, so lookups only open likely files
+    
+    def archive_state(self):
+        """What a snapshot needs to know about the cold segments"""
+        return {'tx_base': self.tx_base, 'archived_sales': from_paise(self.archived_sales), 'segments': sorted(self.segments)}
+    
+    def _load_archive_state(self, state: dict):
+        self.reset_archive()
+        self.tx_base = state.get('tx_base', 0)
+        self.archived_sales = to_paise(state.get('archived_sales', 0))
+        for name in state.get('segments', []):
+            self._index_segment(name)
+    
+    def _segment_path(self, name: str):
+        return os.path.join(self.archive_dir, name)
+    
+    def _segment_rows(self, name: str):
+        """Yield the rows of a cold segment after its header"""
+        with gzip.open(self._segment_path(name), "rt", encoding="utf-8") as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+    
+    def _index_segment(self, name: str):
+        """Register a segment from its header line without reading the rest"""
+        try:
+            with gzip.open(self._segment_path(name), "rt", encoding="utf-8") as f:
+                header = json.loads(f.readline())[2]
+            self.segments[name] = {
+                'payment_ids': set(header['payment_ids']),
+                'user_ids': set(header['user_ids']),
+                'utrs': set(header.get('utrs', []))
+            }
+        except Exception as e:
+            logging.error(f"Cold segment {name} is unavailable: {e}")
+            self.segments[name] = {'payment_ids': set(), 'user_ids': set(), 'utrs': set()}
+    
+    def _drop_archived(self, name: str, info: dict):
+        """Remove records that now live in segment name from memory"""
+        archived_users = {t.user_id for t in self.data['transactions'][:info['transactions']]}
+        del self.data['transactions'][:info['transactions']]
+        self.tx_base += info['transactions']
+        # Recent buffers keep their records; only the positions leave memory
+        for user_id in archived_users:
+            positions = self.tx_positions[user_id]
+            del positions[:bisect.bisect_left(positions, self.tx_base)]
+            if not positions:
+                del self.tx_positions[user_id]
+        for payment_id in info['payments']:
+            self._unindex_utr(self.data['payments'].pop(payment_id, None))
+        self.archived_sales += to_paise(info['sales'])
+        self._index_segment(name)
+        self.rebuild_statistics()  # /statics lists in-memory transactions only
+    
+    def plan_archive(self, older_than: datetime, verified_before: datetime):
+        """Pick old transactions and settled payments for a cold segment, or None if nothing is due
+
+        Transactions leave from the front of the list only, so positions stay
+        contiguous; payments go once created before older_than or verified
+        before verified_before.
+        """
+        if self.archive_dir is None:
+            return None
+        
+        cutoff, verified_cutoff = to_micros(older_than), to_micros(verified_before)
+        count = 0
+        for transaction in self.data['transactions']:
+            if transaction.created_at >= cutoff:
+                break
+            count += 1
+        payments = [
+            p for p in self.data['payments'].values()
+            if p.created_at < cutoff or (p.status == 'verified' and (p.verified_at or 0) < verified_cutoff)
+        ]
+        if not count and not payments:
+            return None
+        return {
+            'name': f"segment.{self.seq + 1:020d}.jsonl.gz",
+            'tx_base': self.tx_base,
+            'transactions': self.data['transactions'][:count],
+            # Status and UTR as planned, so finish_archive can tell a payment that changed meanwhile
+            'payments': [(p, p.status, p.utr) for p in payments]
+        }
+    
+    def write_archive(self, plan: dict):
+        """Write a planned segment file; touches no shared state, so it may run in a worker thread"""
+        transactions = plan['transactions']
+        payments = [p for p, _, _ in plan['payments']]
+        header = {
+            'payment_ids': [p.payment_id for p in payments],
+            'user_ids': sorted({t.user_id for t in transactions}),
+            'utrs': [p.utr for p in payments if p.utr]
+        }
+        rows = [['segment', plan['name'], header]]
+        rows += [['payments', p.payment_id, p.to_dict()] for p in payments]
+        rows += [['transactions', plan['tx_base'] + i, t.to_dict()] for i, t in enumerate(transactions)]
+        os.makedirs(self.archive_dir, exist_ok=True)
+        write_file_atomic(
+            self._segment_path(plan['name']),
+            gzip.compress("".join(json.dumps(row, default=str) + "\n" for row in rows).encode())
+        )
+    
+    def finish_archive(self, plan: dict):
+        """Drop the records of a written segment from memory; returns how many moved"""
+        if self.tx_base != plan['tx_base']:
+            return 0  # the data was replaced meanwhile; the segment file is left unreferenced
+        transactions = plan['transactions']
+        # A payment verified while the segment was written stays in memory, which lookups check first
+        payments = [p.payment_id for p, status, utr in plan['payments'] if (p.status, p.utr) == (status, utr)]
+        info = {
+            'transactions': len(transactions),
+            'payments': payments,
+            'sales': from_paise(sum(t.amount for t in transactions if t.type == 'purchase_twitter'))
+        }
+        self._drop_archived(plan['name'], info)
+        self._record('archive', [['archive', plan['name'], info]])
+        logging.info(f"Archived {len(transactions)} transactions and {len(payments)} payments to {plan['name']}")
+        return len(transactions) + len(payments)
+    
+    def archive(self, older_than: datetime, verified_before: datetime):
+        """Move old transactions and settled payments to a compressed segment file
+
+        Returns how many records moved.
+        """
+        plan = self.plan_archive(older_than, verified_before)
+        if plan is None:
+            return 0
+        self.write_archive(plan)
+        return self.finish_archive(plan)
+    
+    def read_segment(self, name: str):
+        """Return a segment file's bytes, e.g. for an off-site copy"""
+        with open(self._segment_path(name), "rb") as f:
+            return f.read()
+    
+    def write_segment(self, name: str, blob: bytes):
+        """Put a segment file in place before a snapshot that references it is imported"""
+        if self.archive_dir is None:
+            # Nowhere to keep it, so its records come back into memory on import
+            self.thawing[name] = blob
+            return
+        if not os.path.exists(self._segment_path(name)):
+            os.makedirs(self.archive_dir, exist_ok=True)
+            write_file_atomic(self._segment_path(name), blob)
+    
+    def _cold_payment(self, field: str, value):
+        """Search cold segments, newest first, for a payment whose field equals value"""
+        index = 'payment_ids' if field == 'payment_id' else 'utrs'
+        for name in sorted(self.segments, reverse=True):
+            if value not in self.segments[name][index]:
+                continue
+            for collection, key, payment in self._segment_rows(name):
+                if collection == 'payments' and payment[field] == value:
+                    return Payment.from_dict(payment)
+        return None
+    
+    def _find_payment(self, payment_id: str):
+        """Return a payment from memory, bringing it back from a cold segment if needed"""
+        payment = self.data['payments'].get(payment_id)
+        if payment is None:
+            payment = self._cold_payment('payment_id', payment_id)
+            if payment is not None:
+                # The caller records it as changed, which keeps it hot from now on
+                self.data['payments'][payment_id] = payment
+                self._index_utr(payment)
+        return payment
+    
+    def get_user(self, user_id: int):
+        """Get user from database"""
+        user = self.data['users'].get(str(user_id))
+        return user.to_dict() if user else None
+    
+    def create_user(self, user_id: int, username: str, first_name: str, last_name: str):
+        """Create new user if not exists"""
+        if str(user_id) not in self.data['users']:
+            now = now_micros()
+            user = User(user_id, username, first_name, last_name, join_date=now, last_active=now)
+            self.total_balance += user.balance
+            self.data['users'][str(user_id)] = user
+            self._record('create_user', [['users', str(user_id), user]])
+            return True
+        return False
+    
+    def is_admin(self, user_id: int):
+        """Check if user is admin"""
+        return user_id in self.data['admins']
+    
+    def add_admin(self, user_id: int, added_by: int):
+        """Add new admin"""
+        if user_id not in self.data['admins']:
+            self.data['admins'].append(user_id)
+            self._record('add_admin', [['admins', None, self.data['admins']]])
+            return True
+        return False
+    
+    def remove_admin(self, user_id: int):
+        """Remove admin"""
+        if user_id in self.data['admins'] and user_id != self.default_admin:
+            self.data['admins'].remove(user_id)
+            self._record('remove_admin', [['admins', None, self.data['admins']]])
+            return True
+        return False
+    
+    def get_all_admins(self):
+        """Get all admin IDs"""
+        return self.data['admins']
+    
+    def update_twitter_price(self, new_price: float):
+        """Update Twitter account price"""
+        self.data['admin_settings']['twitter_price'] = new_price
+        self.catalog_version += 1
+        self._record('update_twitter_price', [['admin_settings', 'twitter_price', new_price]])
+        return True
+    
+    def get_twitter_price(self):
+        """Get current Twitter account price"""
+        return self.data['admin_settings'].get('twitter_price', self.default_price)
+    
+    def update_balance(self, user_id: int, amount: float, add: bool = True):
+        """Update user balance"""
+        user = self.data['users'].get(str(user_id))
+        if user:
+            change = to_paise(amount) if add else -to_paise(amount)
+            user.balance += change
+            self.total_balance += change
+            self._record('update_balance', [['users', str(user_id), user]])
+            return True
+        return False
+    
+    def add_twitter_account(self, username: str, password: str, email: str, added_by: int):
+        """Add Twitter account to stock"""
+        account_id = len(self.data['twitter_stock']) + 1
+        account = StockAccount(account_id, username, password, email, added_by, added_date=now_micros())
+        self.data['twitter_stock'].append(account)
+        self.free_list.append(account_id)
+        self.available_count += 1
+        self.catalog_version += 1
+        self._record('add_twitter_account', [['twitter_stock', account_id, account]])
+        return account_id
+    
+    def get_available_twitter_count(self):
+        """Get count of available Twitter accounts"""
+        return self.available_count
+    
+    def get_twitter_accounts(self, limit: int = 20):
+        """Get available Twitter accounts"""
+        stock = self.data['twitter_stock']
+        return [stock[account_id - 1].to_dict() for account_id in islice(self._unsold_ids(), limit)]
+    
+    def purchase_twitter_account(self, user_id: int, quantity: int):
+        """Purchase Twitter accounts for user if both their balance and the stock cover it"""
+        reservation = self.reserve_twitter_accounts(user_id, quantity)
+        return self.commit_reservation(reservation['reservation_id']) if reservation else None
+    
+    def reserve_twitter_accounts(self, user_id: int, quantity: int, ttl: float = RESERVATION_TTL):
+        """Hold accounts and funds for a checkout until it is committed, released or expires"""
+        user = self.data['users'].get(str(user_id))
+        current_price = self.get_twitter_price()
+        total_price = quantity * to_paise(current_price)
+        if (self.available_count < quantity or user is None
+                or user.balance - self.reservations.held(user_id) < total_price):
+            return None
+        
+        account_ids = []
+        for i in range(quantity):
+            next(self._unsold_ids())  # drops stale entries so the head is unsold
+            account_ids.append(self.free_list.popleft())
+        self.available_count -= quantity
+        self.catalog_version += 1
+        reservation = self.reservations.add(user_id, current_price, total_price, account_ids, ttl)
+        stock = self.data['twitter_stock']
+        return {
+            'reservation_id': reservation['reservation_id'],
+            'user_id': user_id,
+            'quantity': quantity,
+            'price': current_price,
+            'amount': from_paise(total_price),
+            'accounts': [stock[account_id - 1].to_dict() for account_id in account_ids]
+        }
+    
+    def commit_reservation(self, reservation_id: str, quantity: int = None):
+        """Sell a reservation's accounts, or only its first quantity, and release the rest"""
+        reservation = self.reservations.pop(reservation_id)
+        if reservation is None:
+            return None
+        account_ids = reservation['account_ids']
+        sold_ids = account_ids if quantity is None else account_ids[:quantity]
+        
+        # Unsold ones go back to the head of the queue, oldest first
+        self.free_list.extendleft(reversed(account_ids[len(sold_ids):]))
+        if len(sold_ids) < len(account_ids):
+            self.available_count += len(account_ids) - len(sold_ids)
+            self.catalog_version += 1
+        if not sold_ids:
+            return []
+        
+        user_id = reservation['user_id']
+        user = self.data['users'][str(user_id)]
+        current_price = reservation['price']
+        quantity = len(sold_ids)
+        total_price = quantity * to_paise(current_price)
+        purchased_accounts = []
+        changes = []
+        now = now_micros()
+        stock = self.data['twitter_stock']
+        
+        for account_id in sold_ids:
+            account = stock[account_id - 1]
+            account.sold_to = user_id
+            account.sold_date = now
+            account.is_sold = True
+            purchased_accounts.append(account.to_dict())
+            changes.append(['twitter_stock', account.id, account])
+            
+            # Mark as used
+            self.data['used_twitter_accounts'].add(account.username)
+            changes.append(['used_twitter_accounts', account.username, True])
+        
+        # Update user stats
+        user.balance -= total_price
+        self.total_balance -= total_price
+        user.total_spent += total_price
+        user.total_purchases += quantity
+        changes.append(['users', str(user_id), user])
+        
+        # Create transaction record
+        transaction_id = f"TWITTER_{user_id}_{int(datetime.now().timestamp())}"
+        transaction = Transaction(
+            transaction_id, user_id, total_price, 'purchase_twitter', 'completed',
+            f"Purchased {quantity} Twitter accounts @ ₹{current_price} each",
+            created_at=now, completed_at=now
+        )
+        changes.append(['transactions', self._append_transaction(transaction), transaction])
+        self._record('purchase_twitter_account', changes)
+        
+        return purchased_accounts
+    
+    def pin_reservation(self, reservation_id: str):
+        """Keep a reservation open until it is committed, whatever its expiry"""
+        return self.reservations.pin(reservation_id)
+    
+    def release_reservation(self, reservation_id: str):
+        """Return a reservation's accounts to stock and its funds to the user"""
+        return self.commit_reservation(reservation_id, 0) is not None
+    
+    def expire_reservations(self):
+        """Release reservations past their expiry and return how many there were"""
+        expired = self.reservations.expired()
+        for reservation_id in expired:
+            self.release_reservation(reservation_id)
+        return len(expired)
+    
+    def create_payment(self, payment_id: str, user_id: int):
+        """Create payment record"""
+        payment = Payment(payment_id, user_id, created_at=now_micros())
+        self.data['payments'][payment_id] = payment
+        self._record('create_payment', [['payments', payment_id, payment]])
+        return payment.to_dict()
+    
+    def update_payment_utr(self, payment_id: str, utr: str):
+        """Update payment with UTR"""
+        payment = self._find_payment(payment_id)
+        if payment:
+            self._unindex_utr(payment)
+            payment.utr = utr
+            payment.status = 'pending_verification'
+            self._index_utr(payment)
+            self._record('update_payment_utr', [['payments', payment_id, payment]])
+            return True
+        return False
+    
+    def verify_payment(self, payment_id: str, amount: float, verified_by: int):
+        """Verify a payment"""
+        payment = self._find_payment(payment_id)
+        if payment:
+            now = now_micros()
+            payment.status = 'verified'
+            payment.amount = to_paise(amount)
+            payment.verified_at = now
+            payment.verified_by = verified_by
+            changes = [['payments', payment_id, payment]]
+            
+            # Update user balance
+            user = self.data['users'].get(str(payment.user_id))
+            if user:
+                user.balance += payment.amount
+                self.total_balance += payment.amount
+                changes.append(['users', str(payment.user_id), user])
+            
+            # Create transaction record
+            transaction_id = f"PAYMENT_{payment.user_id}_{int(datetime.now().timestamp())}"
+            transaction = Transaction(
+                transaction_id, payment.user_id, payment.amount, 'add_funds', 'completed',
+                f"Payment via UTR: {payment.utr}",
+                created_at=now, completed_at=now
+            )
+            changes.append(['transactions', self._append_transaction(transaction), transaction])
+            # One log record, so a crash cannot leave a verified payment without its credit
+            self._record('verify_payment', changes)
+            return True
+        return False
+    
+    def get_payment(self, payment_id: str):
+        """Get a payment by id, hot or archived"""
+        payment = self.data['payments'].get(payment_id) or self._cold_payment('payment_id', payment_id)
+        return payment.to_dict() if payment else None
+    
+    def get_payment_by_utr(self, utr: str):
+        """Get the payment a UTR was submitted for, hot or archived"""
+        payment_id = self.utr_index.get(utr)
+        payment = self.data['payments'][payment_id] if payment_id else self._cold_payment('utr', utr)
+        return payment.to_dict() if payment else None
+    
+    def get_admin_setting(self, key: str):
+        """Get admin setting"""
+        return self.data['admin_settings'].get(key)
+    
+    def set_admin_setting(self, key: str, value: str):
+        """Set admin setting"""
+        self.data['admin_settings'][key] = value
+        self.catalog_version += 1
+        self._record('set_admin_setting', [['admin_settings', key, value]])
+        return True
+    
+    def add_transaction(self, transaction: dict):
+        """Append a transaction record"""
+        transaction = Transaction.from_dict(transaction)
+        self._record('add_transaction', [['transactions', self._append_transaction(transaction), transaction]])
+        return True
+    
+    def get_statistics(self):
+        """Get bot statistics from running totals"""
+        total_stock = len(self.data['twitter_stock'])
+        recent_transactions = [entry[2] for entry in sorted(self.recent_heap, reverse=True)]
+        statistics = {
+            'user_count': len(self.data['users']),
+            'total_balance': from_paise(self.total_balance),
+            'total_sales': from_paise(self.total_sales),
+            'total_stock': total_stock,
+            'sold_stock': total_stock - self.available_count - self.reservations.held_count,
+            'available_stock': self.available_count,
+            'admin_count': len(self.data['admins']),
+            'current_price': self.get_twitter_price(),
+            'recent_transactions': [t.to_dict() for t in recent_transactions]
+        }
+        if self.check_statistics:
+            expected = self.recompute_statistics()
+            if not statistics_match(statistics, expected):
+                logging.error(f"Statistics drifted from a full recompute: {statistics} != {expected}")
+        return statistics
+    
+    def recompute_statistics(self):
+        """Get bot statistics by scanning everything; used to check the running totals"""
+        user_count = len(self.data['users'])
+        total_balance = from_paise(sum(user.balance for user in self.data['users'].values()))
+        total_sales = from_paise(self.archived_sales + sum(t.amount for t in self.data['transactions'] if t.type == 'purchase_twitter'))
+        total_stock = len(self.data['twitter_stock'])
+        sold_stock = sum(1 for acc in self.data['twitter_stock'] if acc.is_sold)
+        available_stock = total_stock - sold_stock - self.reservations.held_count
+        admin_count = len(self.data['admins'])
+        current_price = self.get_twitter_price()
+        
+        recent_transactions = heapq.nlargest(STATS_RECENT, self.data['transactions'], key=lambda t: t.created_at)
+        
+        return {
+            'user_count': user_count,
+            'total_balance': total_balance,
+            'total_sales': total_sales,
+            'total_stock': total_stock,
+            'sold_stock': sold_stock,
+            'available_stock': available_stock,
+            'admin_count': admin_count,
+            'current_price': current_price,
+            'recent_transactions': [t.to_dict() for t in recent_transactions]
+        }
+    
+    def get_report(self, period: str, start: datetime, end: datetime):
+        """Rollup totals per hourly or daily bucket from start through end"""
+        return self.rollups.report(period, start, end)
+    
+    def get_all_users(self):
+        """Get all user IDs"""
+        return [int(user_id) for user_id in self.data['users'].keys()]
+    
+    def get_user_transactions(self, user_id: int, limit: int = 5):
+        """Get a user's most recent transactions"""
+        recent = self.recent_tx.get(user_id)
+        if recent is not None and (limit <= len(recent) or len(recent) < RECENT_TRANSACTIONS):
+            return [t.to_dict() for t in reversed(recent[-limit:])]
+        
+        user_transactions = [
+            self.data['transactions'][position - self.tx_base]
+            for position in self.tx_positions.get(user_id, [])
+        ]
+        # Top up from cold segments, newest first, only for users that have records there
+        wanted = max(limit, RECENT_TRANSACTIONS)
+        for name in sorted(self.segments, reverse=True):
+            if len(user_transactions) >= wanted:
+                break
+            if user_id in self.segments[name]['user_ids']:
+                user_transactions += [
+                    Transaction.from_dict(value) for collection, key, value in self._segment_rows(name)
+                    if collection == 'transactions' and value['user_id'] == user_id
+                ]
+        recent = heapq.nlargest(wanted, user_transactions, key=lambda t: t.created_at)
+        # Either full or every segment was read, so a short buffer is complete and lookups stay cached
+        self.recent_tx[user_id] = recent[:RECENT_TRANSACTIONS][::-1]
+        return [t.to_dict() for t in recent[:limit]]
+    
+    def twitter_account_exists(self, username: str):
+        """Check if a Twitter username is already in stock"""
+        return any(acc.username == username for acc in self.data['twitter_stock'])
+
+# ==================== JSON FILE STORAGE ====================
+class JSONFileStorage(MemoryStorage):
+    """In-memory storage made durable by a write-ahead log and checksummed snapshot files"""
+    def __init__(self, data_dir: str, default_admin: int = None, default_price: float = TWITTER_PRICE,
+                 fsync: bool = False, generations: int = 3, check_statistics: bool = False):
+        super().__init__(default_admin, default_price, check_statistics)
+        self.data_dir = data_dir
+        self.archive_dir = os.path.join(data_dir, "archive")
+        self.generations = max(1, generations)
+        self.wal = WriteAheadLog(os.path.join(data_dir, "wal.jsonl"), fsync=fsync)
+        self.compaction_lock = threading.Lock()  # one snapshot write at a time
+        self.load_local()
+    
+    def _log(self, op: str, changes: list):
+        """Log a mutation as the list of (collection, key, value) it produced"""
+        self.wal.append({'seq': self.seq + 1, 'op': op, 'changes': changes})
+    
+    def snapshot_files(self):
+        """Snapshot generations on disk, newest first"""
+        names = [name for name in os.listdir(self.data_dir) if name.startswith("snapshot.") and name.endswith(".snap")]
+        return [os.path.join(self.data_dir, name) for name in sorted(names, reverse=True)]
+    
+    def load_snapshot(self):
+        """Load the newest snapshot generation that passes its checksum"""
+        for path in self.snapshot_files():
+            try:
+                self.data = MemoryStorage(self.default_admin, self.default_price).data
+                self.data['admins'] = []
+                self.reset_archive()
+                self.rollups = None
+                self.seq = read_snapshot_file(path, self._load_row)
+                self.rebuild_free_list()
+                self.rebuild_transaction_index()
+                self.rebuild_statistics()
+                if self.rollups is None:
+                    self.rebuild_rollups()
+                if self.default_admin is not None and self.default_admin not in self.data['admins']:
+                    self.data['admins'].append(self.default_admin)
+                return True
+            except Exception as e:
+                logging.error(f"Skipping snapshot {path}: {e}")
+        return False
+    
+    def load_local(self):
+        """Restore from the local snapshot and replay the log on top of it"""
+        try:
+            self.has_local_state = self.load_snapshot()
+            
+            for record in self.wal.replay():
+                if record['seq'] <= self.seq:
+                    continue  # already folded into the snapshot
+                if record['seq'] != self.seq + 1:
+                    logging.warning(f"WAL gap: snapshot ends at seq {self.seq}, log resumes at {record['seq']}")
+                for collection, key, value in record['changes']:
+                    self._apply_change(collection, key, value)
+                self.seq = record['seq']
+                self.wal.count += 1
+                self.has_local_state = True
+            
+            if self.has_local_state:
+                logging.info(f"Database restored locally up to WAL seq {self.seq}")
+        except Exception as e:
+            logging.error(f"Error loading local database: {e}")
+    
+    def compaction_job(self, min_records: int = 0):
+        """Capture a snapshot once the log holds min_records, or None; the job writes it out
+
+        The log is rotated here, so mutations made while the job runs in a
+        worker thread land in a fresh log that the snapshot does not drop.
+        """
+        if self.wal.count < min_records:
+            return None
+        seq, captured = self.seq, self.capture()
+        self.wal.rotate(seq)
+        
+        def write_snapshot():
+            with self.compaction_lock:
+                path = os.path.join(self.data_dir, f"snapshot.{seq:020d}.snap")
+                write_snapshot_file(path, seq, self.iter_rows(captured))
+                for old_path in self.snapshot_files()[self.generations:]:
+                    os.remove(old_path)
+                self.wal.drop_rotated(seq)
+        return write_snapshot
+    
+    def close(self):
+        """Close the log file"""
+        self.wal.close()
+
+# ==================== SQLITE STORAGE ====================
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    balance REAL NOT NULL DEFAULT 0,
+    total_spent REAL NOT NULL DEFAULT 0,
+    total_purchases INTEGER NOT NULL DEFAULT 0,
+    join_date TEXT,
+    last_active TEXT
+);
+CREATE TABLE IF NOT EXISTS twitter_stock (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    password TEXT,
+    email TEXT,
+    added_by INTEGER,
+    added_date TEXT,
+    sold_to INTEGER,
+    sold_date TEXT,
+    is_sold INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_stock_username ON twitter_stock(username);
+CREATE INDEX IF NOT EXISTS idx_stock_unsold ON twitter_stock(id) WHERE is_sold = 0;
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    amount REAL,
+    utr TEXT,
+    status TEXT,
+    qr_sent INTEGER,
+    created_at TEXT,
+    verified_at TEXT,
+    verified_by INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
+CREATE INDEX IF NOT EXISTS idx_payments_utr ON payments(utr);
+CREATE TABLE IF NOT EXISTS transactions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id TEXT,
+    user_id INTEGER,
+    amount REAL,
+    type TEXT,
+    status TEXT,
+    details TEXT,
+    created_at TEXT,
+    completed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions(type, amount);
+CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at);
+CREATE TABLE IF NOT EXISTS admin_settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS admins (user_id INTEGER NOT NULL UNIQUE);  -- rowid keeps insertion order
+CREATE TABLE IF NOT EXISTS used_twitter_accounts (username TEXT PRIMARY KEY);
+-- Totals of records a file backend archived before its segments could be imported
+CREATE TABLE IF NOT EXISTS archive_state (key TEXT PRIMARY KEY, value REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT NOT NULL,  -- 'hourly' or 'daily'
+    bucket INTEGER NOT NULL,  -- hours or days since the epoch
+    purchases INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,  -- paise
+    deposits INTEGER NOT NULL DEFAULT 0,  -- paise
+    PRIMARY KEY (period, bucket)
+);
+CREATE TABLE IF NOT EXISTS rollup_buyers (
+    period TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    purchases INTEGER NOT NULL,
+    PRIMARY KEY (period, bucket, user_id)
+);
+"""
+
+TRANSACTION_COLUMNS = ('transaction_id', 'user_id', 'amount', 'type', 'status', 'details', 'created_at', 'completed_at')
+
+class SQLiteStorage:
+    """Storage on a local SQLite file in WAL mode, queried through indexes"""
+    def __init__(self, path: str, default_admin: int = None, default_price: float = TWITTER_PRICE,
+                 check_statistics: bool = False):
+        self.default_admin = default_admin
+        self.default_price = default_price
+        self.check_statistics = check_statistics  # compare running totals with a full recompute
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        # Stock held by open reservations; a temp table, so a restart releases it like the other backends
+        self.conn.execute("CREATE TEMP TABLE reserved_stock (id INTEGER PRIMARY KEY)")
+        if default_admin is not None:
+            with self.conn:
+                self.conn.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (default_admin,))
+        self.seq = 0  # mutations since startup
+        self.catalog_version = 0  # lets screens that show stock and price be cached
+        self.compacted_seq = 0  # seq at the last compaction
+        self.on_change = None
+        self.thawing = {}  # segment name -> blob from a file backend, folded into the next import
+        self.clear_dirty()
+        self.count_totals()
+        self.has_local_state = self.conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM twitter_stock)"
+        ).fetchone()[0] == 1
+    
+    # ---------- persistence ----------
+    def count_totals(self):
+        """Recount the running totals after a bulk load; mutations keep them current"""
+        conn = self.conn
+        # Open reservations do not survive a bulk load
+        self.reservations = Reservations()
+        with conn:
+            conn.execute("DELETE FROM reserved_stock")
+        self.user_count, self.total_balance = conn.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM users").fetchone()
+        self.total_sales = self._archived_sales() + conn.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE type = 'purchase_twitter'"
+        ).fetchone()[0]
+        self.total_stock, self.available_count = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(is_sold = 0), 0) FROM twitter_stock"
+        ).fetchone()
+        self.catalog_version += 1
+    
+    def _archived_sales(self, conn=None):
+        row = (conn or self.conn).execute("SELECT value FROM archive_state WHERE key = 'archived_sales'").fetchone()
+        return row[0] if row else 0
+    
+    def _record(self, op: str, changes: list):
+        """Count a committed mutation and remember the (collection, key) it touched"""
+        for collection, key in changes:
+            if collection in self.dirty:
+                self.dirty[collection].add(key)
+        self.seq += 1
+        if self.on_change:
+            self.on_change()
+    
+    @staticmethod
+    def _stock_row(row):
+        account = dict(row)
+        account['is_sold'] = bool(account['is_sold'])
+        return account
+    
+    @staticmethod
+    def _payment_row(row):
+        payment = dict(row)
+        payment['qr_sent'] = bool(payment['qr_sent'])
+        return payment
+    
+    @staticmethod
+    def _transaction_row(row):
+        return {column: row[column] for column in TRANSACTION_COLUMNS}
+    
+    def _insert_transaction(self, transaction: dict, seq: int = None, rollup: bool = True):
+        """Insert a transaction, count it in the rollups and return its seq"""
+        if rollup and seq is not None:
+            old = self.conn.execute("SELECT * FROM transactions WHERE seq = ?", (seq,)).fetchone()
+            if old is not None:
+                self._rollup(dict(old), -1)
+        cursor = self.conn.execute(
+            f"INSERT OR REPLACE INTO transactions (seq, {', '.join(TRANSACTION_COLUMNS)}) VALUES (?, {', '.join('?' * len(TRANSACTION_COLUMNS))})",
+            (seq,) + tuple(transaction.get(column) for column in TRANSACTION_COLUMNS)
+        )
+        if rollup:
+            self._rollup(transaction, 1)
+        return cursor.lastrowid
+    
+    def _rollup(self, transaction: dict, sign: int):
+        """Add (sign=1) or take back (sign=-1) a transaction's share of its rollup buckets"""
+        amounts = contribution(transaction['type'], to_paise(transaction['amount']))
+        if amounts is None:
+            return
+        purchases, revenue, deposits = amounts
+        created_at = to_micros(transaction['created_at'])
+        for period in PERIODS:
+            bucket = bucket_of(period, created_at)
+            self.conn.execute(
+                "INSERT INTO rollups VALUES (?, ?, ?, ?, ?) ON CONFLICT (period, bucket) DO UPDATE SET "
+                "purchases = purchases + excluded.purchases, revenue = revenue + excluded.revenue, deposits = deposits + excluded.deposits",
+                (period, bucket, sign * purchases, sign * revenue, sign * deposits)
+            )
+            if purchases:
+                self.conn.execute(
+                    "INSERT INTO rollup_buyers VALUES (?, ?, ?, ?) ON CONFLICT (period, bucket, user_id) DO UPDATE SET "
+                    "purchases = purchases + excluded.purchases",
+                    (period, bucket, transaction['user_id'], sign)
+                )
+                if sign < 0:
+                    # Only a take-back can empty a buyer's row; the primary key finds it
+                    self.conn.execute(
+                        "DELETE FROM rollup_buyers WHERE period = ? AND bucket = ? AND user_id = ? AND purchases <= 0",
+                        (period, bucket, transaction['user_id'])
+                    )
+    
+    def export_rollups(self, conn=None):
+        """Rollups in the JSON layout used by rollups.Rollups"""
+        conn = conn or self.conn
+        state = {period: [] for period in PERIODS}
+        buyers = {}
+        for row in conn.execute("SELECT * FROM rollup_buyers"):
+            buyers.setdefault((row['period'], row['bucket']), []).append([row['user_id'], row['purchases']])
+        for row in conn.execute("SELECT * FROM rollups ORDER BY period, bucket"):
+            state[row['period']].append([
+                row['bucket'], row['purchases'], row['revenue'], row['deposits'],
+                buyers.get((row['period'], row['bucket']), [])
+            ])
+        return state
+    
+    def _select_in(self, sql: str, keys):
+        """Run sql with an IN (...) placeholder over keys, in batches"""
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            yield from self.conn.execute(sql.format(', '.join('?' * len(batch))), batch)
+    
+    def clear_dirty(self):
+        """Forget changed records, e.g. once a full snapshot covers them"""
+        self.dirty = {collection: set() for collection in DELTA_COLLECTIONS}
+    
+    def export_delta(self):
+        """Return the records changed since the last export and start tracking afresh"""
+        dirty = self.dirty
+        self.clear_dirty()
+        conn = self.conn
+        return {
+            'users': {str(row['user_id']): dict(row) for row in self._select_in("SELECT * FROM users WHERE user_id IN ({})", dirty['users'])},
+            'twitter_stock': [self._stock_row(row) for row in self._select_in("SELECT * FROM twitter_stock WHERE id IN ({})", dirty['twitter_stock'])],
+            'payments': [self._payment_row(row) for row in self._select_in("SELECT * FROM payments WHERE payment_id IN ({})", dirty['payments'])],
+            # Positions match export_data, which lists transactions by seq from 1
+            'transactions': [[row['seq'] - 1, self._transaction_row(row)] for row in self._select_in("SELECT * FROM transactions WHERE seq IN ({})", dirty['transactions'])],
+            'used_twitter_accounts': list(dirty['used_twitter_accounts']),
+            'admin_settings': {row['key']: json.loads(row['value']) for row in conn.execute("SELECT * FROM admin_settings")},
+            'admins': [row['user_id'] for row in conn.execute("SELECT user_id FROM admins ORDER BY rowid")]
+        }
+    
+    def apply_delta(self, delta: dict):
+        """Apply a delta produced by export_delta on top of the current tables"""
+        with self.conn as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users VALUES (:user_id, :username, :first_name, :last_name, :balance, :total_spent, :total_purchases, :join_date, :last_active)",
+                delta['users'].values()
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO twitter_stock VALUES (:id, :username, :password, :email, :added_by, :added_date, :sold_to, :sold_date, :is_sold)",
+                delta['twitter_stock']
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO payments VALUES (:payment_id, :user_id, :amount, :utr, :status, :qr_sent, :created_at, :verified_at, :verified_by)",
+                delta['payments']
+            )
+            for position, transaction in delta['transactions']:
+                self._insert_transaction(transaction, seq=position + 1)
+            conn.executemany(
+                "INSERT OR IGNORE INTO used_twitter_accounts VALUES (?)",
+                ((username,) for username in delta['used_twitter_accounts'])
+            )
+            conn.execute("DELETE FROM admin_settings")
+            conn.executemany(
+                "INSERT INTO admin_settings VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in delta['admin_settings'].items())
+            )
+            conn.execute("DELETE FROM admins")
+            conn.executemany(
+                "INSERT OR IGNORE INTO admins VALUES (?)",
+                ((admin_id,) for admin_id in delta['admins'] + [self.default_admin] if admin_id is not None)
+            )
+        self.count_totals()
+    
+    def export_job(self):
+        """Return a job that reads the tables on a connection of its own, e.g. in a worker thread"""
+        def export():
+            with closing(sqlite3.connect(self.path)) as conn:
+                conn.row_factory = sqlite3.Row
+                with conn:
+                    conn.execute("BEGIN")  # one read snapshot across all tables
+                    return self.export_data(conn)
+        return export
+    
+    def export_data(self, conn=None):
+        """Return the whole database in ChatDatabase's JSON layout"""
+        conn = conn or self.conn
+        return {
+            'users': {str(row['user_id']): dict(row) for row in conn.execute("SELECT * FROM users")},
+            'twitter_stock': [self._stock_row(row) for row in conn.execute("SELECT * FROM twitter_stock ORDER BY id")],
+            'transactions': [self._transaction_row(row) for row in conn.execute("SELECT * FROM transactions ORDER BY seq")],
+            'payments': [self._payment_row(row) for row in conn.execute("SELECT * FROM payments ORDER BY rowid")],
+            'admin_settings': {row['key']: json.loads(row['value']) for row in conn.execute("SELECT * FROM admin_settings")},
+            'used_twitter_accounts': [row['username'] for row in conn.execute("SELECT username FROM used_twitter_accounts")],
+            'admins': [row['user_id'] for row in conn.execute("SELECT user_id FROM admins ORDER BY rowid")],
+            'rollups': self.export_rollups(conn),
+            'archive': {'archived_sales': self._archived_sales(conn), 'segments': []}
+        }
+    
+    def import_data(self, loaded_data: dict):
+        """Replace all tables with a decoded snapshot"""
+        # Archived records from a file backend become ordinary rows here
+        loaded_data = thaw_archive(loaded_data, self.thawing)
+        self.thawing = {}
+        with self.conn as conn:
+            for table in ('users', 'twitter_stock', 'payments', 'transactions', 'admin_settings', 'admins', 'used_twitter_accounts',
+                          'rollups', 'rollup_buyers', 'archive_state'):
+                conn.execute(f"DELETE FROM {table}")
+            # Restart transaction seq at 1 so it keeps matching list positions
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = 'transactions'")
+            conn.executemany(
+                "INSERT INTO users VALUES (:user_id, :username, :first_name, :last_name, :balance, :total_spent, :total_purchases, :join_date, :last_active)",
+                loaded_data.get('users', {}).values()
+            )
+            conn.executemany(
+                "INSERT INTO twitter_stock VALUES (:id, :username, :password, :email, :added_by, :added_date, :sold_to, :sold_date, :is_sold)",
+                loaded_data.get('twitter_stock', [])
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO payments VALUES (:payment_id, :user_id, :amount, :utr, :status, :qr_sent, :created_at, :verified_at, :verified_by)",
+                loaded_data.get('payments', [])
+            )
+            tx_base = loaded_data.get('archive', {}).get('tx_base', 0)
+            conn.execute(
+                "INSERT INTO archive_state VALUES ('archived_sales', ?)",
+                (loaded_data.get('archive', {}).get('archived_sales', 0),)
+            )
+            # Saved rollups also cover archived transactions; older snapshots rebuild from what is here
+            saved_rollups = loaded_data.get('rollups')
+            for position, transaction in enumerate(loaded_data.get('transactions', []), tx_base):
+                self._insert_transaction(transaction, seq=position + 1, rollup=saved_rollups is None)
+            for period, rows in (saved_rollups or {}).items():
+                conn.executemany(
+                    "INSERT INTO rollups VALUES (?, ?, ?, ?, ?)",
+                    ((period, bucket, purchases, revenue, deposits) for bucket, purchases, revenue, deposits, _ in rows)
+                )
+                conn.executemany(
+                    "INSERT INTO rollup_buyers VALUES (?, ?, ?, ?)",
+                    ((period, row[0], user_id, count) for row in rows for user_id, count in row[4])
+                )
+            conn.executemany(
+                "INSERT INTO admin_settings VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in loaded_data.get('admin_settings', {}).items())
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO admins VALUES (?)",
+                ((admin_id,) for admin_id in loaded_data.get('admins', []) + [self.default_admin] if admin_id is not None)
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO used_twitter_accounts VALUES (?)",
+                ((username,) for username in loaded_data.get('used_twitter_accounts', []))
+            )
+        self.count_totals()
+        self.has_local_state = True
+    
+    def compaction_job(self, min_records: int = 0):
+        """Return a job that checkpoints on a connection of its own once min_records were written, or None
+
+        A passive checkpoint never waits for the bot's writes, so the job may
+        run in a worker thread; SQLite reuses the WAL file from its start after it.
+        """
+        if self.seq - self.compacted_seq < min_records:
+            return None
+        self.compacted_seq = self.seq
+        
+        def checkpoint():
+            with closing(sqlite3.connect(self.path)) as conn:
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return checkpoint
+    
+    def compact(self):
+        """Fold the SQLite WAL back into the main database file"""
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.compacted_seq = self.seq
+    
+    def close(self):
+        """Close the connection"""
+        self.conn.close()
+    
+    # ---------- archival ----------
+    def plan_archive(self, older_than: datetime, verified_before: datetime):
+        """Old rows already live on disk behind indexes, so nothing moves"""
+        return None
+    
+    def write_archive(self, plan: dict):
+        raise RuntimeError("SQLite storage keeps no cold segments")
+    
+    def finish_archive(self, plan: dict):
+        raise RuntimeError("SQLite storage keeps no cold segments")
+    
+    def archive(self, older_than: datetime, verified_before: datetime):
+        """Old rows already live on disk behind indexes, so nothing moves"""
+        return 0
+    
+    def read_segment(self, name: str):
+        raise RuntimeError("SQLite storage keeps no cold segments")
+    
+    def write_segment(self, name: str, blob: bytes):
+        """Hold a file backend's segment until import_data turns its records into rows"""
+        self.thawing[name] = blob
+    
+    # ---------- users & admins ----------
+    def get_user(self, user_id: int):
+        """Get user from database"""
+        row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def create_user(self, user_id: int, username: str, first_name: str, last_name: str):
+        """Create new user if not exists"""
+        with self.conn as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_active) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, username, first_name, last_name, str(datetime.now()), str(datetime.now()))
+            )
+        if cursor.rowcount:
+            self.user_count += 1
+            self._record('create_user', [('users', user_id)])
+            return True
+        return False
+    
+    def is_admin(self, user_id: int):
+        """Check if user is admin"""
+        return self.conn.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)).fetchone() is not None
+    
+    def add_admin(self, user_id: int, added_by: int):
+        """Add new admin"""
+        with self.conn as conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+        if cursor.rowcount:
+            self._record('add_admin', [])
+            return True
+        return False
+    
+    def remove_admin(self, user_id: int):
+        """Remove admin"""
+        if user_id == self.default_admin:
+            return False
+        with self.conn as conn:
+            cursor = conn.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+        if cursor.rowcount:
+            self._record('remove_admin', [])
+            return True
+        return False
+    
+    def get_all_admins(self):
+        """Get all admin IDs"""
+        return [row[0] for row in self.conn.execute("SELECT user_id FROM admins ORDER BY rowid")]
+    
+    def get_all_users(self):
+        """Get all user IDs"""
+        return [row[0] for row in self.conn.execute("SELECT user_id FROM users")]
+    
+    def update_balance(self, user_id: int, amount: float, add: bool = True):
+        """Update user balance"""
+        with self.conn as conn:
+            cursor = conn.execute(
+                "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+                (amount if add else -amount, user_id)
+            )
+        if cursor.rowcount:
+            self.total_balance += amount if add else -amount
+            self._record('update_balance', [('users', user_id)])
+            return True
+        return False
+    
+    # ---------- settings ----------
+    def get_admin_setting(self, key: str):
+        """Get admin setting"""
+        row = self.conn.execute("SELECT value FROM admin_settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set_admin_setting(self, key: str, value: str):
+        """Set admin setting"""
+        with self.conn as conn:
+            conn.execute("INSERT OR REPLACE INTO admin_settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        self.catalog_version += 1
+        self._record('set_admin_setting', [])
+        return True
+    
+    def update_twitter_price(self, new_price: float):
+        """Update Twitter account price"""
+        return self.set_admin_setting('twitter_price', new_price)
+    
+    def get_twitter_price(self):
+        """Get current Twitter account price"""
+        price = self.get_admin_setting('twitter_price')
+        return self.default_price if price is None else price
+    
+    # ---------- stock ----------
+    def add_twitter_account(self, username: str, password: str, email: str, added_by: int):
+        """Add Twitter account to stock"""
+        with self.conn as conn:
+            cursor = conn.execute(
+                "INSERT INTO twitter_stock (username, password, email, added_by, added_date) VALUES (?, ?, ?, ?, ?)",
+                (username, password, email, added_by, str(datetime.now()))
+            )
+        self.available_count += 1
+        self.total_stock += 1
+        self.catalog_version += 1
+        self._record('add_twitter_account', [('twitter_stock', cursor.lastrowid)])
+        return cursor.lastrowid
+    
+    def twitter_account_exists(self, username: str):
+        """Check if a Twitter username is already in stock"""
+        return self.conn.execute("SELECT 1 FROM twitter_stock WHERE username = ?", (username,)).fetchone() is not None
+    
+    def get_available_twitter_count(self):
+        """Get count of available Twitter accounts"""
+        return self.available_count
+    
+    def get_twitter_accounts(self, limit: int = 20):
+        """Get available Twitter accounts"""
+        rows = self.conn.execute("SELECT * FROM twitter_stock WHERE is_sold = 0 ORDER BY id LIMIT ?", (limit,))
+        return [self._stock_row(row) for row in rows]
+    
+    def purchase_twitter_account(self, user_id: int, quantity: int):
+        """Purchase Twitter accounts for user if both their balance and the stock cover it"""
+        reservation = self.reserve_twitter_accounts(user_id, quantity)
+        return self.commit_reservation(reservation['reservation_id']) if reservation else None
+    
+    def reserve_twitter_accounts(self, user_id: int, quantity: int, ttl: float = RESERVATION_TTL):
+        """Hold accounts and funds for a checkout until it is committed, released or expires"""
+        current_price = self.get_twitter_price()
+        total_price = quantity * current_price
+        
+        with self.conn as conn:
+            user = conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if user is None or user['balance'] - self.reservations.held(user_id) < total_price:
+                return None
+            rows = conn.execute(
+                "SELECT * FROM twitter_stock WHERE is_sold = 0 AND id NOT IN (SELECT id FROM reserved_stock) ORDER BY id LIMIT ?",
+                (quantity,)
+            ).fetchall()
+            if len(rows) < quantity:
+                return None
+            conn.executemany("INSERT INTO reserved_stock VALUES (?)", ((row['id'],) for row in rows))
+        self.available_count -= quantity
+        self.catalog_version += 1
+        reservation = self.reservations.add(user_id, current_price, total_price, [row['id'] for row in rows], ttl)
+        return {
+            'reservation_id': reservation['reservation_id'],
+            'user_id': user_id,
+            'quantity': quantity,
+            'price': current_price,
+            'amount': total_price,
+            'accounts': [self._stock_row(row) for row in rows]
+        }
+    
+    def commit_reservation(self, reservation_id: str, quantity: int = None):
+        """Sell a reservation's accounts, or only its first quantity, and release the rest"""
+        reservation = self.reservations.pop(reservation_id)
+        if reservation is None:
+            return None
+        account_ids = reservation['account_ids']
+        sold_ids = account_ids if quantity is None else account_ids[:quantity]
+        user_id = reservation['user_id']
+        current_price = reservation['price']
+        quantity = len(sold_ids)
+        total_price = quantity * current_price
+        now = str(datetime.now())
+        
+        with self.conn as conn:
+            conn.executemany("DELETE FROM reserved_stock WHERE id = ?", ((account_id,) for account_id in account_ids))
+            if quantity < len(account_ids):
+                self.available_count += len(account_ids) - quantity
+                self.catalog_version += 1
+            if not sold_ids:
+                return []
+            
+            rows = sorted(self._select_in("SELECT * FROM twitter_stock WHERE id IN ({})", sold_ids), key=lambda row: row['id'])
+            purchased_accounts = []
+            for row in rows:
+                account = self._stock_row(row)
+                account.update(sold_to=user_id, sold_date=now, is_sold=True)
+                purchased_accounts.append(account)
+            conn.executemany(
+                "UPDATE twitter_stock SET is_sold = 1, sold_to = ?, sold_date = ? WHERE id = ?",
+                ((user_id, now, account['id']) for account in purchased_accounts)
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO used_twitter_accounts (username) VALUES (?)",
+                ((account['username'],) for account in purchased_accounts)
+            )
+            
+            # Update user stats; the funds were held since the reservation
+            conn.execute(
+                "UPDATE users SET balance = balance - ?, total_spent = total_spent + ?, total_purchases = total_purchases + ? WHERE user_id = ?",
+                (total_price, total_price, quantity, user_id)
+            )
+            
+            # Create transaction record
+            transaction_seq = self._insert_transaction({
+                'transaction_id': f"TWITTER_{user_id}_{int(datetime.now().timestamp())}",
+                'user_id': user_id,
+                'amount': total_price,
+                'type': 'purchase_twitter',
+                'status': 'completed',
+                'details': f"Purchased {quantity} Twitter accounts @ ₹{current_price} each",
+                'created_at': now,
+                'completed_at': now
+            })
+        self.total_sales += total_price
+        self.total_balance -= total_price
+        changes = [('twitter_stock', account['id']) for account in purchased_accounts]
+        changes += [('used_twitter_accounts', account['username']) for account in purchased_accounts]
+        changes += [('users', user_id), ('transactions', transaction_seq)]
+        self._record('purchase_twitter_account', changes)
+        return purchased_accounts
+    
+    def pin_reservation(self, reservation_id: str):
+        """Keep a reservation open until it is committed, whatever its expiry"""
+        return self.reservations.pin(reservation_id)
+    
+    def release_reservation(self, reservation_id: str):
+        """Return a reservation's accounts to stock and its funds to the user"""
+        return self.commit_reservation(reservation_id, 0) is not None
+    
+    def expire_reservations(self):
+        """Release reservations past their expiry and return how many there were"""
+        expired = self.reservations.expired()
+        for reservation_id in expired:
+            self.release_reservation(reservation_id)
+        return len(expired)
+    
+    # ---------- payments & transactions ----------
+    def create_payment(self, payment_id: str, user_id: int):
+        """Create payment record"""
+        payment = {
+            'payment_id': payment_id,
+            'user_id': user_id,
+            'amount': None,
+            'utr': None,
+            'status': 'pending',
+            'qr_sent': True,
+            'created_at': str(datetime.now()),
+            'verified_at': None,
+            'verified_by': None
+        }
+        with self.conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO payments VALUES (:payment_id, :user_id, :amount, :utr, :status, :qr_sent, :created_at, :verified_at, :verified_by)",
+                payment
+            )
+        self._record('create_payment', [('payments', payment_id)])
+        return payment
+    
+    def update_payment_utr(self, payment_id: str, utr: str):
+        """Update payment with UTR"""
+        with self.conn as conn:
+            cursor = conn.execute(
+                "UPDATE payments SET utr = ?, status = 'pending_verification' WHERE payment_id = ?",
+                (utr, payment_id)
+            )
+        if cursor.rowcount:
+            self._record('update_payment_utr', [('payments', payment_id)])
+            return True
+        return False
+    
+    def verify_payment(self, payment_id: str, amount: float, verified_by: int):
+        """Verify a payment"""
+        with self.conn as conn:
+            payment = conn.execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+            if payment is None:
+                return False
+            now = str(datetime.now())
+            conn.execute(
+                "UPDATE payments SET status = 'verified', amount = ?, verified_at = ?, verified_by = ? WHERE payment_id = ?",
+                (amount, now, verified_by, payment_id)
+            )
+            
+            # Update user balance
+            user_updated = conn.execute(
+                "UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, payment['user_id'])
+            ).rowcount
+            
+            # Create transaction record
+            transaction_seq = self._insert_transaction({
+                'transaction_id': f"PAYMENT_{payment['user_id']}_{int(datetime.now().timestamp())}",
+                'user_id': payment['user_id'],
+                'amount': amount,
+                'type': 'add_funds',
+                'status': 'completed',
+                'details': f"Payment via UTR: {payment['utr'] or 'N/A'}",
+                'created_at': now,
+                'completed_at': now
+            })
+        if user_updated:
+            self.total_balance += amount
+        self._record('verify_payment', [('payments', payment_id), ('users', payment['user_id']), ('transactions', transaction_seq)])
+        return True
+    
+    def get_payment(self, payment_id: str):
+        """Get a payment by id"""
+        row = self.conn.execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+        return self._payment_row(row) if row else None
+    
+    def get_payment_by_utr(self, utr: str):
+        """Get the payment a UTR was submitted for"""
+        row = self.conn.execute("SELECT * FROM payments WHERE utr = ? ORDER BY rowid DESC LIMIT 1", (utr,)).fetchone()
+        return self._payment_row(row) if row else None
+    
+    def add_transaction(self, transaction: dict):
+        """Append a transaction record"""
+        with self.conn:
+            transaction_seq = self._insert_transaction(transaction)
+        if transaction['type'] == 'purchase_twitter':
+            self.total_sales += transaction['amount']
+        self._record('add_transaction', [('transactions', transaction_seq)])
+        return True
+    
+    def get_user_transactions(self, user_id: int, limit: int = 5):
+        """Get a user's most recent transactions"""
+        rows = self.conn.execute(
+            "SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        )
+        return [self._transaction_row(row) for row in rows]
+    
+    def get_statistics(self):
+        """Get bot statistics from running totals"""
+        recent_transactions = [
+            self._transaction_row(row)
+            for row in self.conn.execute("SELECT * FROM transactions ORDER BY created_at DESC LIMIT ?", (STATS_RECENT,))
+        ]
+        statistics = {
+            'user_count': self.user_count,
+            'total_balance': self.total_balance,
+            'total_sales': self.total_sales,
+            'total_stock': self.total_stock,
+            'sold_stock': self.total_stock - self.available_count - self.reservations.held_count,
+            'available_stock': self.available_count,
+            'admin_count': self.conn.execute("SELECT COUNT(*) FROM admins").fetchone()[0],
+            'current_price': self.get_twitter_price(),
+            'recent_transactions': recent_transactions
+        }
+        if self.check_statistics:
+            expected = self.recompute_statistics()
+            if not statistics_match(statistics, expected):
+                logging.error(f"Statistics drifted from a full recompute: {statistics} != {expected}")
+        return statistics
+    
+    def get_report(self, period: str, start: datetime, end: datetime):
+        """Rollup totals per hourly or daily bucket from start through end, via the primary key"""
+        bounds = (period, bucket_of(period, to_micros(start)), bucket_of(period, to_micros(end)))
+        rows = [
+            tuple(row) for row in self.conn.execute(
+                "SELECT r.bucket, r.purchases, r.revenue, r.deposits, "
+                "(SELECT COUNT(*) FROM rollup_buyers b WHERE b.period = r.period AND b.bucket = r.bucket) "
+                "FROM rollups r WHERE r.period = ? AND r.bucket BETWEEN ? AND ? ORDER BY r.bucket",
+                bounds
+            )
+        ]
+        buyers = self.conn.execute(
+            "SELECT COUNT(DISTINCT user_id) FROM rollup_buyers WHERE period = ? AND bucket BETWEEN ? AND ?", bounds
+        ).fetchone()[0]
+        return report_totals(period, rows, buyers)
+    
+    def recompute_statistics(self):
+        """Get bot statistics with aggregate queries; used to check the running totals"""
+        conn = self.conn
+        user_count, total_balance = conn.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM users").fetchone()
+        total_sales = self._archived_sales() + conn.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE type = 'purchase_twitter'"
+        ).fetchone()[0]
+        total_stock, sold_stock = conn.execute("SELECT COUNT(*), COALESCE(SUM(is_sold), 0) FROM twitter_stock").fetchone()
+        available_stock = conn.execute(
+            "SELECT COUNT(*) FROM twitter_stock WHERE is_sold = 0 AND id NOT IN (SELECT id FROM reserved_stock)"
+        ).fetchone()[0]
+        recent_transactions = [
+            self._transaction_row(row)
+            for row in conn.execute("SELECT * FROM transactions ORDER BY created_at DESC LIMIT ?", (STATS_RECENT,))
+        ]
+        
+        return {
+            'user_count': user_count,
+            'total_balance': total_balance,
+            'total_sales': total_sales,
+            'total_stock': total_stock,
+            'sold_stock': sold_stock,
+            'available_stock': available_stock,
+            'admin_count': conn.execute("SELECT COUNT(*) FROM admins").fetchone()[0],
+            'current_price': self.get_twitter_price(),
+            'recent_transactions': recent_transactions
+        }
+
+def open_storage(backend: str, data_dir: str, sqlite_path: str = None,
+                 default_admin: int = None, default_price: float = TWITTER_PRICE,
+                 fsync: bool = False, generations: int = 3, check_statistics: bool = False):
+    """Create the storage backend named by backend ("memory", "json" or "sqlite")"""
+    if backend == "memory":
+        return MemoryStorage(default_admin, default_price, check_statistics)
+    if backend == "json":
+        return JSONFileStorage(data_dir, default_admin, default_price, fsync=fsync, generations=generations,
+                               check_statistics=check_statistics)
+    if backend == "sqlite":
+        return SQLiteStorage(sqlite_path or os.path.join(data_dir, "bot.sqlite3"), default_admin, default_price,
+                             check_statistics)
+    raise ValueError(f"Unknown storage backend: {backend}")